@@ -1,11 +1,30 @@
 import os
+import gc
 import json
+import math
+import heapq
+import hashlib
+import time
+from contextlib import contextmanager
+import sqlite3
+import multiprocessing
 from collections import Counter, defaultdict
+from collections.abc import Mapping
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from rapidfuzz import process
 from rapidfuzz.distance import Levenshtein
+import numpy as np
 import argparse
 import glob
 
+from barcode_codec import packed_to_dna
+
+# 热路径计数（候选配对数、完全匹配、无候选、UMI 比较等），工作进程随批次结果返回增量；
+# 只在 --stats 时计数（COLLECT_STATS 由 main 和 init_worker 设置）
+HOT_COUNTERS = Counter()
+COLLECT_STATS = False
+
+
 # 按基因个数排序条形码
 def sort_sequences_by_gene_count(data):
     """根据基因对应的条形码数量对基因进行降序排序"""
@@ -24,13 +43,202 @@ def sort_genes_by_sequence_count(gene_counts):
 # 计算编辑距离（优化后）
 def calculate_levenshtein_distance(barcode, s_barcode_list, max_distance):
     """计算与目标条形码在设定阈值范围内的编辑距离"""
-    return [(s_barcode, Levenshtein.distance(s_barcode, barcode))
-            for s_barcode in s_barcode_list
-            if Levenshtein.distance(s_barcode, barcode) <= max_distance]
+    # score_cutoff 使超出阈值的距离直接返回 max_distance + 1，每对只计算一次
+    dis_pairs = ((s_barcode, Levenshtein.distance(s_barcode, barcode, score_cutoff=max_distance))
+                 for s_barcode in s_barcode_list)
+    return [(s_barcode, dis) for s_barcode, dis in dis_pairs if dis <= max_distance]
+
+
+# 碱基 -> 2 bit 编码查找表，非 ACGT 字符标记为 255
+_NT_2BIT = np.full(256, 255, dtype=np.uint8)
+for _code, _nt in enumerate(b"ACGT"):
+    _NT_2BIT[_nt] = _code
+
+
+def pack_barcodes(s_barcode_list):
+    """将等长（<=32bp）的 ACGT 条形码打包为 uint64 数组，无法打包时返回 None"""
+    if not s_barcode_list:
+        return None
+    length = len(s_barcode_list[0])
+    if length == 0 or length > 32 or any(len(s) != length for s in s_barcode_list):
+        return None
+    try:
+        raw = "".join(s_barcode_list).encode("ascii")
+    except UnicodeEncodeError:
+        return None
+    codes = _NT_2BIT[np.frombuffer(raw, dtype=np.uint8)].reshape(-1, length)
+    if (codes == 255).any():
+        return None
+    packed = np.zeros(len(s_barcode_list), dtype=np.uint64)
+    for j in range(length):
+        packed = (packed << np.uint64(2)) | codes[:, j].astype(np.uint64)
+    return packed, length
+
+
+def packed_peq(packed, length):
+    """由打包条形码生成每种碱基的位置掩码表，形状 (4, n)，第 i 位对应条形码第 i 个碱基"""
+    peq = np.zeros((4, len(packed)), dtype=np.uint64)
+    for i in range(length):
+        codes = (packed >> np.uint64(2 * (length - 1 - i))) & np.uint64(3)
+        for code in range(4):
+            peq[code] |= (codes == code).astype(np.uint64) << np.uint64(i)
+    return peq
+
+
+def _popcount64(values):
+    """uint64 数组逐元素计数置位"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values).astype(np.int64)
+    values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    values = (values & np.uint64(0x3333333333333333)) + ((values >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    values = (values + (values >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((values * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int64)
+
+
+def myers_levenshtein_packed(barcode, peq, length):
+    """Myers/Hyyrö 位并行算法，一次计算 barcode 与一组打包条形码的编辑距离
+
+    SRS 条形码作为模式（每个占一个 uint64 的低 length 位），逐个碱基扫描 barcode；
+    高于 length 的位只会向上进位，不影响结果，因此循环内不需要掩码。
+    """
+    n = peq.shape[1]
+    one = np.uint64(1)
+    no_match = np.zeros(n, dtype=np.uint64)
+    vp = np.full(n, np.uint64((1 << length) - 1), dtype=np.uint64)
+    vn = np.zeros(n, dtype=np.uint64)
+
+    for nt in barcode.encode("ascii", "replace"):
+        code = _NT_2BIT[nt]
+        eq = peq[code] if code != 255 else no_match
+        x = eq | vn
+        d0 = (((x & vp) + vp) ^ vp) | x
+        hp = vn | ~(d0 | vp)
+        hn = vp & d0
+        x = (hp << one) | one
+        vn = x & d0
+        vp = (hn << one) | ~(x | d0)
+
+    # 最后一列：D[length] = D[0] + 各行纵向差之和，D[0] 为 barcode 长度
+    mask = np.uint64((1 << length) - 1)
+    return len(barcode) + _popcount64(vp & mask) - _popcount64(vn & mask)
+
+
+def calculate_levenshtein_distance_packed(barcode, s_barcode_list, packed_info, max_distance):
+    """与 calculate_levenshtein_distance 结果一致，packed_info 为 None 时退回逐对计算"""
+    if packed_info is None:
+        return calculate_levenshtein_distance(barcode, s_barcode_list, max_distance)
+    peq, length = packed_info
+    distances = myers_levenshtein_packed(barcode, peq, length)
+    return [(s_barcode_list[i], int(distances[i])) for i in np.flatnonzero(distances <= max_distance)]
+
+
+# 位并行内核每列固定有十几次 numpy 调用，列表较短时逐对计算更快
+PACKED_MIN_LIST_SIZE = 1024
+
+
+class PackedBarcodeMatcher:
+    """按基因缓存打包后的 SRS 条形码，每个基因只打包一次；短列表直接逐对计算"""
+
+    def __init__(self, min_list_size=PACKED_MIN_LIST_SIZE):
+        self.min_list_size = min_list_size
+        self.packed = {}
+
+    def __call__(self, l_barcode, l_gene, s_barcode_list, max_distance):
+        if l_gene not in self.packed:
+            packed_info = None
+            if len(s_barcode_list) >= self.min_list_size:
+                packed_info = pack_barcodes(s_barcode_list)
+            if packed_info is not None:
+                packed_info = (packed_peq(*packed_info), packed_info[1])
+            self.packed[l_gene] = packed_info
+        return calculate_levenshtein_distance_packed(l_barcode, s_barcode_list, self.packed[l_gene], max_distance)
+
+
+class CachedBarcodeMatcher:
+    """逐对计算编辑距离，并缓存当前 LRS 条形码的配对距离和按 SRS 列表的结果
+
+    一个 SRS 条形码通常属于多个基因，同一 LRS 条形码在不同基因下会重复遇到同一配对；
+    SRS 列表完全相同的基因直接复用结果。缓存只保留当前 LRS 条形码，内存有界。
+
+    gene_list_ids 为父进程用 make_gene_list_ids 预先分配的 {基因: 列表编号}，fork 后各工作进程共享；
+    未提供或不含该基因时按列表内容摘要现场分配，只保存摘要，不复制列表。
+    """
+
+    def __init__(self, gene_list_ids=None):
+        self.shared_list_ids = gene_list_ids or {}
+        self.digest_ids = {}
+        self.gene_list_ids = {}
+        self.stats = Counter()
+        self._barcode = None
+        self._max_distance = None
+        self._pairs = {}
+        self._lists = {}
+
+    def _list_id(self, l_gene, s_barcode_list):
+        """返回基因 SRS 列表的编号，内容相同的列表编号相同，每个基因只计算一次"""
+        list_id = self.shared_list_ids.get(l_gene)
+        if list_id is None:
+            list_id = self.gene_list_ids.get(l_gene)
+        if list_id is None:
+            # 负数编号与父进程分配的编号区分开
+            list_id = -1 - self.digest_ids.setdefault(list_digest(s_barcode_list), len(self.digest_ids))
+            self.gene_list_ids[l_gene] = list_id
+        return list_id
+
+    def __call__(self, l_barcode, l_gene, s_barcode_list, max_distance):
+        if l_barcode != self._barcode or max_distance != self._max_distance:
+            self._barcode, self._max_distance = l_barcode, max_distance
+            self._pairs, self._lists = {}, {}
+
+        list_id = self._list_id(l_gene, s_barcode_list)
+        if list_id in self._lists:
+            self.stats["gene_hits"] += 1
+            return self._lists[list_id]
+        self.stats["gene_misses"] += 1
+
+        pairs = self._pairs
+        n_pairs = len(pairs)
+        dis_list = []
+        for s_barcode in s_barcode_list:
+            dis = pairs.get(s_barcode)
+            if dis is None:
+                dis = pairs[s_barcode] = Levenshtein.distance(s_barcode, l_barcode, score_cutoff=max_distance)
+            if dis <= max_distance:
+                dis_list.append((s_barcode, dis))
+        self.stats["pair_misses"] += len(pairs) - n_pairs
+        self.stats["pair_hits"] += len(s_barcode_list) - (len(pairs) - n_pairs)
+        self._lists[list_id] = dis_list
+        return dis_list
+
+
+def list_digest(s_barcode_list):
+    """SRS 条形码列表（有序）的内容摘要"""
+    return hashlib.blake2b("\n".join(s_barcode_list).encode(), digest_size=16).digest()
+
+
+def make_gene_list_ids(gene_barcode_data):
+    """在父进程中一次性为每个基因的 SRS 列表分配编号，内容相同的列表共用一个编号"""
+    digest_ids = {}
+    return {gene: digest_ids.setdefault(list_digest(s_barcode_list), len(digest_ids))
+            for gene, s_barcode_list in gene_barcode_data.items()}
+
+
+def make_matcher(engine, gene_list_ids=None):
+    """根据 --engine 构建距离计算函数，签名为 (l_barcode, l_gene, s_barcode_list, max_distance)"""
+    if engine == "rapidfuzz":
+        return lambda l_barcode, l_gene, s_barcode_list, max_distance: \
+            calculate_levenshtein_distance(l_barcode, s_barcode_list, max_distance)
+    if engine == "packed":
+        return PackedBarcodeMatcher()
+    if engine == "cached":
+        return CachedBarcodeMatcher(gene_list_ids)
+    raise ValueError(f"Unknown engine: {engine}")
 
 
 
 def calculate_result(gene_dict):
+    if COLLECT_STATS and not any(gene_dict.values()):
+        HOT_COUNTERS["no_candidate_barcodes"] += 1
     # 初始化分类变量
     invalid_barcode=[]
     consistent_barcode = None
@@ -83,16 +291,22 @@ def calculate_result(gene_dict):
     }        
 
 
-def best_barcode(barcode_gene, gene_barcode_data, min_dis):
+def barcode_gene_hits(barcode_gene, gene_barcode_data, min_dis, matcher):
+    """计算单个 LRS 条形码在各基因下距离最小的 SRS 条形码，返回 gene_dict"""
     l_barcode, l_gene_list = barcode_gene
     gene_dict = {}
     for l_gene in l_gene_list:
         s_barcode_list = gene_barcode_data.get(l_gene, [])
         if s_barcode_list:
             if l_barcode in s_barcode_list:
+                if COLLECT_STATS:
+                    HOT_COUNTERS["exact_hits"] += 1
                 gene_dict[l_gene] = [l_barcode]
             else:
-                dis_list = calculate_levenshtein_distance(l_barcode, s_barcode_list, min_dis)
+                if COLLECT_STATS:
+                    # 交给匹配器的配对数；cached 引擎实际计算的配对见 pair_misses
+                    HOT_COUNTERS["candidate_pairs"] += len(s_barcode_list)
+                dis_list = matcher(l_barcode, l_gene, s_barcode_list, min_dis)
                 if dis_list:
                     min_dis_pair = min(dis_list, key=lambda x: x[1])
                     gene_dict[l_gene]=[t[0] for t in dis_list if t[1] == min_dis_pair[1]]
@@ -100,19 +314,267 @@ def best_barcode(barcode_gene, gene_barcode_data, min_dis):
                     gene_dict[l_gene]=[]   
         else:
             continue
-    return {l_barcode:calculate_result(gene_dict)}
+    return gene_dict
+
+
+def best_barcode(barcode_gene, gene_barcode_data, min_dis, matcher=None):
+    if matcher is None:
+        matcher = make_matcher("rapidfuzz")
+    gene_dict = barcode_gene_hits(barcode_gene, gene_barcode_data, min_dis, matcher)
+    return {barcode_gene[0]:calculate_result(gene_dict)}
 
 
 # 批量处理条形码
-def process_batch(batch, gene_barcode_data, min_dis):
+def process_batch(batch, gene_barcode_data, min_dis, engine="rapidfuzz", matcher=None):
     """并行处理条形码批次"""
     batch_results = {}
+    if matcher is None:
+        matcher = make_matcher(engine)
     for barcode_gene in batch:
-        result = best_barcode(barcode_gene, gene_barcode_data, min_dis)
+        result = best_barcode(barcode_gene, gene_barcode_data, min_dis, matcher)
         batch_results.update(result)
     return batch_results
 
 
+# 工作进程内的参考数据，由 init_worker 在进程启动时设置一次
+_WORKER_STATE = {}
+
+
+def init_worker(gene_barcode_data, min_dis, engine, s_gb_dict, l_gb_dict, gene_list_ids=None, collect_stats=False):
+    """进程池初始化：每个工作进程只接收一次参考数据和 UMI 字典，并只构建一次距离匹配器"""
+    global COLLECT_STATS
+    COLLECT_STATS = collect_stats
+    _WORKER_STATE["gene_barcode_data"] = gene_barcode_data
+    _WORKER_STATE["min_dis"] = min_dis
+    _WORKER_STATE["matcher"] = make_matcher(engine, gene_list_ids)
+    _WORKER_STATE["s_gb_dict"] = s_gb_dict
+    _WORKER_STATE["l_gb_dict"] = l_gb_dict
+
+
+def _worker_counters():
+    """当前工作进程的累计计数：热路径计数加上匹配器自身的统计（如缓存命中）"""
+    return HOT_COUNTERS + Counter(getattr(_WORKER_STATE["matcher"], "stats", {}))
+
+
+def process_worker_batch(batch):
+    """在工作进程中完成条形码匹配和 UMI 校正，只有 batch 本身需要序列化
+
+    返回 ((multi_dict, wrong_dict, best_barcode_dict), 本批次的计数与耗时)。
+    """
+    counters_before = _worker_counters()
+    start = time.perf_counter()
+    batch_results = process_batch(batch, _WORKER_STATE["gene_barcode_data"], _WORKER_STATE["min_dis"],
+                                  matcher=_WORKER_STATE["matcher"])
+    distance_done = time.perf_counter()
+    outputs = process_barcodes(batch_results, _WORKER_STATE["s_gb_dict"], _WORKER_STATE["l_gb_dict"])
+    stats = _worker_counters() - counters_before
+    stats["time_distance"] = distance_done - start
+    stats["time_umi"] = time.perf_counter() - distance_done
+    return outputs, stats
+
+
+def process_worker_distance(batch):
+    """在工作进程中只做条形码匹配，返回 (batch_results, 计数与耗时)，供父进程写入结果缓存"""
+    counters_before = _worker_counters()
+    start = time.perf_counter()
+    batch_results = process_batch(batch, _WORKER_STATE["gene_barcode_data"], _WORKER_STATE["min_dis"],
+                                  matcher=_WORKER_STATE["matcher"])
+    stats = _worker_counters() - counters_before
+    stats["time_distance"] = time.perf_counter() - start
+    return batch_results, stats
+
+
+def process_worker_umi(batch_results):
+    """在工作进程中只做 UMI 校正（基因模式和拆分片段在父进程汇总后使用）"""
+    counters_before = Counter(HOT_COUNTERS)
+    start = time.perf_counter()
+    outputs = process_barcodes(batch_results, _WORKER_STATE["s_gb_dict"], _WORKER_STATE["l_gb_dict"])
+    stats = Counter(HOT_COUNTERS) - counters_before
+    stats["time_umi"] = time.perf_counter() - start
+    return outputs, stats
+
+
+def process_worker_pieces(pieces):
+    """在工作进程中处理拆分后的条形码片段，返回 ([(l_barcode, 部分 gene_dict)], 计数与耗时)"""
+    counters_before = _worker_counters()
+    start = time.perf_counter()
+    piece_results = [(l_barcode, barcode_gene_hits((l_barcode, l_gene_list), _WORKER_STATE["gene_barcode_data"],
+                                                   _WORKER_STATE["min_dis"], _WORKER_STATE["matcher"]))
+                     for l_barcode, l_gene_list in pieces]
+    stats = _worker_counters() - counters_before
+    stats["time_distance"] = time.perf_counter() - start
+    return piece_results, stats
+
+
+def make_executor(max_workers, gene_barcode_data, min_dis, engine, s_gb_dict, l_gb_dict, collect_stats=False):
+    """创建进程池；支持 fork 时子进程直接继承参考数据，不经过 pickle"""
+    mp_context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    # cached 引擎的列表编号在父进程中只分配一次，各工作进程共享
+    gene_list_ids = make_gene_list_ids(gene_barcode_data) if engine == "cached" else None
+    # 冻结已有对象，避免子进程的垃圾回收触碰继承的内存页而触发写时复制
+    gc.freeze()
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=init_worker,
+                               initargs=(gene_barcode_data, min_dis, engine, s_gb_dict, l_gb_dict, gene_list_ids,
+                                         collect_stats))
+
+
+# 按计算量调度批次
+def estimate_barcode_cost(l_gene_list, gene_barcode_data):
+    """估计单个 LRS 条形码的计算量：其所有基因对应的 SRS 条形码数之和"""
+    return sum(len(gene_barcode_data.get(l_gene, ())) for l_gene in l_gene_list)
+
+
+def split_gene_list(l_gene_list, gene_barcode_data, target_cost):
+    """把计算量过大的条形码按基因顺序切成计算量约为 target_cost 的片段"""
+    chunks, chunk, chunk_cost = [], [], 0
+    for l_gene in l_gene_list:
+        chunk.append(l_gene)
+        chunk_cost += len(gene_barcode_data.get(l_gene, ()))
+        if chunk_cost >= target_cost:
+            chunks.append(chunk)
+            chunk, chunk_cost = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def make_cost_batches(barcode_gene_data, gene_barcode_data, batch_size, max_workers, split_heavy=False):
+    """按估计计算量构建批次，返回 (批次列表, 片段任务列表)
+
+    批次数不少于 ceil(条形码数 / batch_size) 与 4 * max_workers；条形码按计算量降序
+    放入当前最轻的批次，批次按总计算量降序返回（LPT）。split_heavy 时，计算量超过
+    单批目标的条形码按基因拆成片段单独提交，由父进程合并后再调用 calculate_result。
+    """
+    costs = [(estimate_barcode_cost(l_gene_list, gene_barcode_data), l_barcode, l_gene_list)
+             for l_barcode, l_gene_list in barcode_gene_data.items()]
+    if not costs:
+        return [], []
+    n_batches = min(len(costs), max(math.ceil(len(costs) / batch_size), 4 * max_workers))
+    target_cost = max(1, sum(cost for cost, _, _ in costs) / n_batches)
+
+    piece_tasks = []
+    if split_heavy:
+        heavy = [item for item in costs if item[0] > target_cost]
+        costs = [item for item in costs if item[0] <= target_cost]
+        for _, l_barcode, l_gene_list in heavy:
+            piece_tasks.extend([(l_barcode, chunk)] for chunk in split_gene_list(l_gene_list, gene_barcode_data, target_cost))
+
+    batches = [[] for _ in range(n_batches)]
+    heap = [(0, i) for i in range(n_batches)]
+    for cost, l_barcode, l_gene_list in sorted(costs, key=lambda item: item[0], reverse=True):
+        batch_cost, i = heapq.heappop(heap)
+        batches[i].append((l_barcode, l_gene_list))
+        heapq.heappush(heap, (batch_cost + cost, i))
+    batch_costs = dict((i, batch_cost) for batch_cost, i in heap)
+    order = sorted(range(n_batches), key=lambda i: batch_costs[i], reverse=True)
+    return [batches[i] for i in order if batches[i]], piece_tasks
+
+
+def merge_gene_pieces(barcode_gene_data, piece_results):
+    """按条形码原有基因顺序合并片段结果，得到与 process_batch 相同的结构"""
+    batch_results = {}
+    for l_barcode, partial in piece_results.items():
+        gene_dict = {l_gene: partial[l_gene] for l_gene in barcode_gene_data[l_barcode] if l_gene in partial}
+        batch_results[l_barcode] = calculate_result(gene_dict)
+    return batch_results
+
+
+# 按基因计算距离矩阵
+def invert_barcode_gene(barcode_gene_data, gene_barcode_data):
+    """将 LRS 条形码->基因 反转为 基因->LRS 条形码，只保留 SRS 中有条形码的基因"""
+    gene_lrs_data = defaultdict(list)
+    for l_barcode, l_gene_list in barcode_gene_data.items():
+        for l_gene in l_gene_list:
+            if gene_barcode_data.get(l_gene):
+                gene_lrs_data[l_gene].append(l_barcode)
+    return gene_lrs_data
+
+
+def gene_distance_hits(l_barcode_list, s_barcode_list, min_dis, chunk_cells=1 << 24):
+    """一次计算一个基因的 LRS×SRS 编辑距离矩阵，返回 {l_barcode: 最小距离的SRS条形码列表}
+
+    没有命中的 LRS 条形码不出现在结果中；按行分块避免大基因的矩阵占用过多内存。
+    """
+    hits = {}
+    chunk_rows = max(1, chunk_cells // len(s_barcode_list))
+    for start in range(0, len(l_barcode_list), chunk_rows):
+        l_chunk = l_barcode_list[start:start + chunk_rows]
+        matrix = process.cdist(l_chunk, s_barcode_list, scorer=Levenshtein.distance,
+                               score_cutoff=min_dis, dtype=np.int32, workers=1)
+        row_min = matrix.min(axis=1)
+        if COLLECT_STATS:
+            HOT_COUNTERS["candidate_pairs"] += matrix.size
+            HOT_COUNTERS["exact_hits"] += int((row_min == 0).sum())
+        for row in np.flatnonzero(row_min <= min_dis):
+            l_barcode = l_chunk[row]
+            if row_min[row] == 0:
+                # 与 best_barcode 一致：完全匹配时只保留自身
+                hits[l_barcode] = [l_barcode]
+            else:
+                hits[l_barcode] = [s_barcode_list[col] for col in np.flatnonzero(matrix[row] == row_min[row])]
+    return hits
+
+
+def process_gene_batch(gene_batch, min_dis):
+    """并行处理基因批次，gene_batch 为 [(基因, LRS条形码列表, SRS条形码列表)]；返回 (命中结果, 统计)"""
+    counters_before = Counter(HOT_COUNTERS)
+    start = time.perf_counter()
+    gene_hits = {gene: gene_distance_hits(l_barcode_list, s_barcode_list, min_dis)
+                 for gene, l_barcode_list, s_barcode_list in gene_batch}
+    stats = Counter(HOT_COUNTERS) - counters_before
+    stats["time_distance"] = time.perf_counter() - start
+    return gene_hits, stats
+
+
+def make_gene_batches(gene_lrs_data, gene_barcode_data, batch_size):
+    """按 LRS 条形码个数累计到 batch_size 切分基因批次"""
+    batches, batch, batch_len = [], [], 0
+    for gene, l_barcode_list in gene_lrs_data.items():
+        batch.append((gene, l_barcode_list, gene_barcode_data[gene]))
+        batch_len += len(l_barcode_list)
+        if batch_len >= batch_size:
+            batches.append(batch)
+            batch, batch_len = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def collect_gene_hits(executor, barcode_gene_data, gene_barcode_data, min_dis, batch_size, lpt=False):
+    """以基因为单位调度距离计算，返回 ({基因: {l_barcode: 命中列表}}, 统计, 计算失败的基因集合)"""
+    gene_lrs_data = invert_barcode_gene(barcode_gene_data, gene_barcode_data)
+    gene_batches = make_gene_batches(gene_lrs_data, gene_barcode_data, batch_size)
+    if lpt:
+        # 矩阵大小作为计算量，最重的基因批次先提交
+        gene_batches.sort(key=lambda gene_batch: sum(len(l) * len(s) for _, l, s in gene_batch), reverse=True)
+    futures = {executor.submit(process_gene_batch, gene_batch, min_dis): i for i, gene_batch in enumerate(gene_batches)}
+    gene_hits = {}
+    stats = Counter()
+    failed_genes = set()
+    for future in as_completed(futures):
+        try:
+            batch_hits, batch_stats = future.result()
+            gene_hits.update(batch_hits)
+            stats.update(batch_stats)
+        except Exception as e:
+            print(f"Error processing gene batch {futures[future]}: {e}")
+            # 失败基因的命中结果缺失，调用方需将涉及这些基因的条形码批次记为失败
+            failed_genes.update(gene for gene, _, _ in gene_batches[futures[future]])
+    return gene_hits, stats, failed_genes
+
+
+def assemble_batch_results(batch, gene_barcode_data, gene_hits):
+    """按每个 LRS 条形码原有的基因顺序重组命中结果，得到与 process_batch 相同的结构"""
+    batch_results = {}
+    for l_barcode, l_gene_list in batch:
+        gene_dict = {}
+        for l_gene in l_gene_list:
+            if gene_barcode_data.get(l_gene):
+                gene_dict[l_gene] = gene_hits.get(l_gene, {}).get(l_barcode, [])
+        batch_results[l_barcode] = calculate_result(gene_dict)
+    return batch_results
+
+
 def merge_json_files(output_dir, merged_file_path,sep="best_dict"):
     merged_data = {}
     # 构建匹配所有批次文件的模式
@@ -127,13 +589,329 @@ def merge_json_files(output_dir, merged_file_path,sep="best_dict"):
         # 合并数据
         merged_data.update(data)
     
-    # 将合并后的数据保存到新的 JSON 文件中
-    with open(merged_file_path, 'w') as f:
+    # 将合并后的数据先写入临时文件再替换，中断时不会留下不完整的结果文件
+    tmp_path = merged_file_path + ".tmp"
+    with open(tmp_path, 'w') as f:
         json.dump(merged_data, f, indent=4)
-    
-    # 删除所有批次文件
-    for file_path in batch_files:
-        os.remove(file_path)
+    os.replace(tmp_path, merged_file_path)
+
+
+def remove_batch_files(output_dir):
+    """删除所有批次文件；在检查点标记完成之后调用，中断的合并可以用 --resume 从批次文件重做"""
+    for sep in OUTPUT_FILES:
+        for file_path in glob.glob(os.path.join(output_dir, "barcode_{}_batch_*.json".format(sep))):
+            os.remove(file_path)
+
+# 最终结果文件名
+OUTPUT_FILES = {
+    "best_dict": "barcode_best.json",
+    "multi_dict": "barcode_multi_dict.json",
+    "wrong_dict": "barcode_wrong_dict.json",
+}
+
+
+class StreamingResultWriter:
+    """流式写出批次结果，替代逐批 indent=4 JSON 文件加 glob 合并
+
+    每个批次的字典去掉首尾花括号后作为一行紧凑 JSON 片段追加到 .part 文件，
+    结束时用 "{" + 各行以逗号拼接 + "}" 生成最终文件，全程不重新解析 JSON。
+    """
+
+    def __init__(self, output_dir, offsets=None):
+        self.output_dir = output_dir
+        self.part_paths = {sep: os.path.join(output_dir, name + ".part") for sep, name in OUTPUT_FILES.items()}
+        if offsets:
+            # 续跑：截掉最后一个已完成批次之后写入的内容，再继续追加
+            for sep, path in self.part_paths.items():
+                os.truncate(path, offsets[sep])
+            self.part_files = {sep: open(path, "a") for sep, path in self.part_paths.items()}
+        else:
+            self.part_files = {sep: open(path, "w") for sep, path in self.part_paths.items()}
+
+    def offsets(self):
+        """落盘并返回各 .part 文件当前长度，记录到检查点"""
+        for part_file in self.part_files.values():
+            part_file.flush()
+            os.fsync(part_file.fileno())
+        return {sep: part_file.tell() for sep, part_file in self.part_files.items()}
+
+    def write(self, sep, data):
+        if data:
+            part_file = self.part_files[sep]
+            part_file.write(json.dumps(data, separators=(",", ":"))[1:-1] + "\n")
+            part_file.flush()
+
+    def close(self):
+        """拼接 .part 文件生成最终 JSON（先写临时文件再替换），.part 文件保留到 remove_parts"""
+        for sep, part_file in self.part_files.items():
+            part_file.close()
+            final_path = os.path.join(self.output_dir, OUTPUT_FILES[sep])
+            with open(self.part_paths[sep]) as src, open(final_path + ".tmp", "w") as dst:
+                dst.write("{")
+                for i, line in enumerate(src):
+                    if i:
+                        dst.write(",")
+                    dst.write(line.rstrip("\n"))
+                dst.write("}")
+            os.replace(final_path + ".tmp", final_path)
+
+    def remove_parts(self):
+        """检查点标记完成后删除 .part 文件"""
+        for path in self.part_paths.values():
+            os.remove(path)
+
+
+# 检查点清单文件名
+CHECKPOINT_FILE = "barcode_adjust_checkpoint.json"
+
+
+def file_fingerprint(path, content=False, chunk_size=1 << 20):
+    """输入文件指纹，用于判断续跑时输入是否变化；目录（CSR、.packed 输入）按文件名顺序逐个计入
+
+    默认只取文件大小和修改时间（纳秒），不读取内容，大型 UMI JSON / SQLite 输入也不增加开销；
+    content=True 时计算内容的 sha256，供 --shard 使用：各分片可能在不同机器上读取复制的输入，
+    修改时间不可比，合并分片时按内容核对输入一致。
+    """
+    digest = hashlib.sha256()
+    paths = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+    for file_path in paths:
+        digest.update(os.path.basename(file_path).encode())
+        if content:
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    digest.update(chunk)
+        else:
+            stat = os.stat(file_path)
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    """--output-dir 中的检查点清单：输入文件指纹、运行参数、已完成和失败的批次编号
+
+    --resume 时输入或参数与清单不一致会抛出 ValueError，避免混入不同运行的结果。
+    """
+
+    def __init__(self, output_dir, inputs, params, resume=False):
+        self.path = os.path.join(output_dir, CHECKPOINT_FILE)
+        self.state = {"inputs": inputs, "params": params, "completed": [], "failed": [],
+                      "stream_offsets": None, "finished": False}
+        if resume and os.path.exists(self.path):
+            with open(self.path) as f:
+                previous = json.load(f)
+            if previous["inputs"] != inputs:
+                raise ValueError(f"Input files changed since the checkpoint in {self.path} was written")
+            if previous["params"] != params:
+                raise ValueError(f"Parameters differ from the checkpoint in {self.path}: {previous['params']}")
+            self.state.update(completed=previous["completed"], stream_offsets=previous["stream_offsets"],
+                              finished=previous["finished"])
+        self.completed = set(self.state["completed"])
+        self.save()
+
+    def done(self, batch_index):
+        return batch_index in self.completed
+
+    def mark_completed(self, batch_index, stream_offsets=None):
+        self.completed.add(batch_index)
+        self.state["completed"].append(batch_index)
+        if batch_index in self.state["failed"]:
+            self.state["failed"].remove(batch_index)
+        self.state["stream_offsets"] = stream_offsets
+        self.save()
+
+    def mark_failed(self, batch_index):
+        if batch_index not in self.state["failed"]:
+            self.state["failed"].append(batch_index)
+        self.save()
+
+    def mark_finished(self):
+        self.state["finished"] = True
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+
+# 多机分片
+def parse_shard(value):
+    """解析 --shard 参数 "i/N"，返回 (i, N)，要求 0 <= i < N"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must look like i/N, got {value!r}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must satisfy 0 <= i < N, got {value!r}")
+    return index, count
+
+
+def shard_of(l_barcode, shard_count):
+    """按条形码的稳定哈希（与进程、PYTHONHASHSEED 无关）分配分片编号"""
+    digest = hashlib.md5(l_barcode.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
+
+
+def select_shard(barcode_gene_data, shard):
+    index, count = shard
+    return {l_barcode: l_gene_list for l_barcode, l_gene_list in barcode_gene_data.items()
+            if shard_of(l_barcode, count) == index}
+
+
+def merge_shards(shard_dirs, output_dir):
+    """合并各分片 --output-dir 中的最终结果，得到与单机运行相同的三个结果文件
+
+    根据各分片的检查点确认分片完整、均已完成，且输入文件和其余参数一致；
+    各分片的 LRS 条形码互不重叠，直接合并字典即可。
+    """
+    states = []
+    for shard_dir in shard_dirs:
+        checkpoint_path = os.path.join(shard_dir, CHECKPOINT_FILE)
+        if not os.path.exists(checkpoint_path):
+            raise ValueError(f"No checkpoint found in {shard_dir}")
+        with open(checkpoint_path) as f:
+            state = json.load(f)
+        if not state["finished"]:
+            raise ValueError(f"Shard run in {shard_dir} has not finished")
+        if not state["params"].get("shard"):
+            raise ValueError(f"{shard_dir} was not produced by a --shard run")
+        states.append(state)
+
+    reference = states[0]
+    shard_count = reference["params"]["shard"][1]
+    for shard_dir, state in zip(shard_dirs, states):
+        if state["params"]["shard"][1] != shard_count:
+            raise ValueError(f"Shard in {shard_dir} is one of {state['params']['shard'][1]} shards, "
+                             f"but {shard_dirs[0]} is one of {shard_count}")
+        if state["inputs"] != reference["inputs"]:
+            raise ValueError(f"Shard in {shard_dir} was run on different input files")
+        params = dict(state["params"], shard=None)
+        if params != dict(reference["params"], shard=None):
+            raise ValueError(f"Shard in {shard_dir} was run with different parameters: {state['params']}")
+    indices = sorted(state["params"]["shard"][0] for state in states)
+    if indices != list(range(shard_count)):
+        raise ValueError(f"Expected shards 0..{shard_count - 1} exactly once, got {indices}")
+
+    for name in OUTPUT_FILES.values():
+        merged_data = {}
+        for shard_dir in shard_dirs:
+            with open(os.path.join(shard_dir, name)) as f:
+                merged_data.update(json.load(f))
+        with open(os.path.join(output_dir, name), "w") as f:
+            json.dump(merged_data, f, indent=4)
+
+
+class ResultCache:
+    """持久化的 calculate_result 结果缓存（SQLite），用于增量重跑
+
+    键由 LRS 条形码、其基因列表（含顺序）、所引用基因的 SRS 条形码列表摘要和 min_dis
+    决定，上游数据变化的条形码自然失效，只有这些条形码需要重新计算。
+    """
+
+    def __init__(self, path, gene_barcode_data, min_dis):
+        self.path = path
+        self.gene_barcode_data = gene_barcode_data
+        self.min_dis = min_dis
+        self.stats = Counter()
+        self._gene_digests = {}
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS calc_result (key TEXT PRIMARY KEY, result TEXT NOT NULL) WITHOUT ROWID")
+        self._conn.commit()
+
+    def _gene_digest(self, gene):
+        digest = self._gene_digests.get(gene)
+        if digest is None:
+            s_barcode_list = self.gene_barcode_data.get(gene, [])
+            digest = hashlib.sha256(json.dumps(s_barcode_list).encode()).hexdigest()
+            self._gene_digests[gene] = digest
+        return digest
+
+    def key(self, l_barcode, l_gene_list):
+        gene_digests = [self._gene_digest(l_gene) for l_gene in l_gene_list]
+        return hashlib.sha256(json.dumps([l_barcode, l_gene_list, gene_digests, self.min_dis]).encode()).hexdigest()
+
+    def lookup(self, batch, chunk_size=500):
+        """返回 (已缓存的 {l_barcode: 结果}, 需要重新计算的 [(l_barcode, 基因列表)])"""
+        keys = {l_barcode: self.key(l_barcode, l_gene_list) for l_barcode, l_gene_list in batch}
+        key_list = list(keys.values())
+        found = {}
+        for i in range(0, len(key_list), chunk_size):
+            chunk = key_list[i:i + chunk_size]
+            query = "SELECT key, result FROM calc_result WHERE key IN ({})".format(",".join("?" * len(chunk)))
+            found.update(self._conn.execute(query, chunk))
+        hits = {l_barcode: json.loads(found[key]) for l_barcode, key in keys.items() if key in found}
+        misses = [(l_barcode, l_gene_list) for l_barcode, l_gene_list in batch if l_barcode not in hits]
+        self.stats["result_cache_hits"] += len(hits)
+        self.stats["result_cache_misses"] += len(misses)
+        return hits, misses
+
+    def store(self, batch_results, barcode_gene_data):
+        self._conn.executemany("INSERT OR REPLACE INTO calc_result (key, result) VALUES (?, ?)",
+                               ((self.key(l_barcode, barcode_gene_data[l_barcode]), json.dumps(result))
+                                for l_barcode, result in batch_results.items()))
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def ordered_results(batch, *result_dicts):
+    """按批次内条形码顺序合并缓存命中与新计算的结果"""
+    merged = {}
+    for results in result_dicts:
+        merged.update(results)
+    return {l_barcode: merged[l_barcode] for l_barcode, _ in batch if l_barcode in merged}
+
+
+# 运行统计报告文件名
+STATS_FILE = "barcode_adjust_stats.json"
+# 批次耗时直方图各桶的上界（秒）
+LATENCY_BUCKETS = (0.1, 1, 10, 60, 600, 3600)
+
+
+class RunStats:
+    """汇总父进程各阶段耗时、工作进程返回的计数与耗时，以及批次耗时直方图"""
+
+    def __init__(self):
+        self.stages = Counter()
+        self.counters = Counter()
+        self.latency = Counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def add_worker(self, stats):
+        """累加工作进程返回的统计，time_* 计入阶段耗时（各进程耗时之和），其余为计数"""
+        for key, value in stats.items():
+            if key.startswith("time_"):
+                self.stages["worker_" + key[len("time_"):]] += value
+            else:
+                self.counters[key] += value
+
+    def add_batch_latency(self, seconds):
+        label = next((f"<{bound}s" for bound in LATENCY_BUCKETS if seconds < bound), f">={LATENCY_BUCKETS[-1]}s")
+        self.latency[label] += 1
+
+    def write(self, output_dir, params):
+        labels = [f"<{bound}s" for bound in LATENCY_BUCKETS] + [f">={LATENCY_BUCKETS[-1]}s"]
+        report = {
+            "params": params,
+            "stage_seconds": {k: round(v, 6) for k, v in sorted(self.stages.items())},
+            "counters": dict(sorted(self.counters.items())),
+            "batches": sum(self.latency.values()),
+            "batch_latency_histogram": {label: self.latency[label] for label in labels},
+        }
+        stats_path = os.path.join(output_dir, STATS_FILE)
+        with open(stats_path, "w") as f:
+            json.dump(report, f, indent=4)
+        return stats_path
+
 
 def process_barcodes(result, s_gb_dict, l_gb_dict):
     multi_dict = {}
@@ -162,60 +940,237 @@ def process_barcodes(result, s_gb_dict, l_gb_dict):
 
     return multi_dict, wrong_dict, best_barcode_dict
 
+class SqliteUmiStore:
+    """按需查询 generate_umi_json.py --format sqlite 生成的 UMI 索引，代替整体加载 JSON
+
+    提供 in / [] / get 接口；连接按进程懒加载，fork 后的子进程各自打开只读连接。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {"path": self.path, "_conn": None, "_pid": None}
+
+    def _query(self, key):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            self._pid = os.getpid()
+        row = self._conn.execute("SELECT umi FROM gene_barcode_umi WHERE gb = ?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get(self, key, default=None):
+        value = self._query(key)
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return self._query(key) is not None
+
+    def __getitem__(self, key):
+        value = self._query(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+
+class PackedUmiStore:
+    """按需查询 generate_umi_json.py --format packed 生成的目录（keys/indptr/umis 均为内存映射）
+
+    提供 in / [] / get 接口，返回排序去重后的 UMI 序列；packed 返回 2-bit 整数数组，可直接做集合运算。
+    无法打包的 UMI（含 N、长度不同等）存于 extra_indptr/extra_umis，get 时一并返回，结果与 JSON 输入一致。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._arrays = None
+        self._extra = None
+
+    def __getstate__(self):
+        return {"path": self.path, "_arrays": None, "_extra": None}
+
+    def _load(self):
+        if self._arrays is None:
+            self._arrays = tuple(np.load(os.path.join(self.path, name), mmap_mode="r")
+                                 for name in ("keys.npy", "indptr.npy", "umis.npy"))
+            self.umi_length = int(np.load(os.path.join(self.path, "umi_length.npy")))
+            self._extra = None
+            if os.path.exists(os.path.join(self.path, "extra_umis.npy")):
+                self._extra = tuple(np.load(os.path.join(self.path, name), mmap_mode="r")
+                                    for name in ("extra_indptr.npy", "extra_umis.npy"))
+        return self._arrays
+
+    def _row(self, key):
+        keys = self._load()[0]
+        if keys.dtype.kind == "S":
+            key = key.encode()
+        i = int(np.searchsorted(keys, key))
+        if i == len(keys) or keys[i] != key:
+            return None
+        return i
+
+    def packed(self, key):
+        """只返回可打包的 UMI（2-bit 整数数组），不含 extra_umis 中的 UMI"""
+        i = self._row(key)
+        if i is None:
+            return None
+        _, indptr, umis = self._arrays
+        return np.asarray(umis[indptr[i]:indptr[i + 1]])
+
+    def get(self, key, default=None):
+        i = self._row(key)
+        if i is None:
+            return default
+        _, indptr, umis = self._arrays
+        value = packed_to_dna(np.asarray(umis[indptr[i]:indptr[i + 1]]), self.umi_length)
+        if self._extra is not None:
+            extra_indptr, extra_umis = self._extra
+            value = value + extra_umis[extra_indptr[i]:extra_indptr[i + 1]].tolist()
+        return value
+
+    def __contains__(self, key):
+        return self._row(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+
+def load_umi_dict(path):
+    """加载 UMI 字典：.sqlite/.db 文件按需查询，目录按 packed 格式按需查询，其他按 JSON 整体加载"""
+    if os.path.isdir(path):
+        return PackedUmiStore(path)
+    if path.endswith((".sqlite", ".db")):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return SqliteUmiStore(path)
+    with open(path) as f:
+        return json.load(f)
+
+
+class CsrDict(Mapping):
+    """按需读取 generate_barcode_json.py --output_format csr 生成的目录，代替还原整个 {键: 字符串列表}
+
+    names/indptr/indices 以内存映射方式读取，加载时只建立 键->行号 索引；某个键第一次被访问时
+    才切片 names[indices[indptr[i]:indptr[i + 1]]] 生成字符串列表，并在当前进程中保留供后续复用。
+    未被访问的键始终只占用各进程共享的映射页。fork 前父进程已访问的列表由工作进程继承。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._arrays = None
+        self._lists = {}
+        keys = np.load(os.path.join(path, "keys.npy"), mmap_mode="r").tolist()
+        self._rows = {key: i for i, key in enumerate(keys)}
+
+    def __getstate__(self):
+        return {"path": self.path, "_arrays": None, "_lists": {}, "_rows": self._rows}
+
+    def _load(self):
+        if self._arrays is None:
+            self._arrays = tuple(np.load(os.path.join(self.path, name), mmap_mode="r")
+                                 for name in ("names.npy", "indptr.npy", "indices.npy"))
+        return self._arrays
+
+    def __getitem__(self, key):
+        value = self._lists.get(key)
+        if value is None:
+            i = self._rows[key]
+            names, indptr, indices = self._load()
+            value = self._lists[key] = names[indices[indptr[i]:indptr[i + 1]]].tolist()
+        return value
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+
+def load_csr_dict(path):
+    """加载 CSR 目录为按需读取的只读映射（CsrDict），接口与 json.load 得到的字典相同"""
+    return CsrDict(path)
+
+
+def load_barcode_dict(path):
+    """加载基因/条形码字典：目录按 CSR 格式读取，其他按 JSON 整体加载"""
+    if os.path.isdir(path):
+        return load_csr_dict(path)
+    with open(path) as f:
+        return json.load(f)
+
+
+# UMI 校正：候选条形码与 LRS 条形码的 UMI 集合最小编辑距离不超过该值才算支持
+UMI_MAX_DISTANCE = 4
+
+
+def encode_umis(umis):
+    """UMI 列表去重（保持顺序），重复的 UMI 不影响集合间的最小距离"""
+    return tuple(dict.fromkeys(umis))
+
+
+def umi_set_distance(l_umis, s_umis, max_distance=UMI_MAX_DISTANCE):
+    """两组 UMI 的最小编辑距离，超过 max_distance 时返回 max_distance + 1
+
+    有相同 UMI 时直接返回 0，否则用一次 cdist 计算整个距离矩阵。
+    """
+    if not l_umis or not s_umis:
+        return max_distance + 1
+    if COLLECT_STATS:
+        HOT_COUNTERS["umi_set_comparisons"] += 1
+    if not set(l_umis).isdisjoint(s_umis):
+        if COLLECT_STATS:
+            HOT_COUNTERS["umi_exact_hits"] += 1
+        return 0
+    if COLLECT_STATS:
+        HOT_COUNTERS["umi_pair_evaluations"] += len(l_umis) * len(s_umis)
+    matrix = process.cdist(l_umis, s_umis, scorer=Levenshtein.distance,
+                           score_cutoff=max_distance, dtype=np.int32, workers=1)
+    return int(matrix.min())
+
+
+def umi_best_candidate(g, lb, sb_list, s_gb_dict, l_gb_dict):
+    """在基因 g 下的候选 SRS 条形码中找 UMI 距离最小的一个，都不满足阈值时返回 None"""
+    l_umis = encode_umis(l_gb_dict.get(f"{g}_{lb}", []))
+    tmp_result = {}
+    for k in sb_list:
+        s_umis = s_gb_dict.get(f"{g}_{k}")
+        if s_umis is not None:
+            u_dis = umi_set_distance(l_umis, encode_umis(s_umis))
+            if u_dis <= UMI_MAX_DISTANCE:
+                tmp_result[k] = u_dis
+                if u_dis == 0:
+                    # 距离为 0 已是最小值，后面的候选不会被选中
+                    break
+    if tmp_result:
+        return min(tmp_result, key=tmp_result.get)
+    return None
+
+
 def process_multiple_barcode(multiple_barcode, lb, best_barcode_list, multi_dict, s_gb_dict, l_gb_dict):
     for g, sb_list in multiple_barcode.items():
-        lbu = f"{g}_{lb}"
-        tmp_result = {}
-        for k in sb_list:
-            sbu = f"{g}_{k}"
-            if sbu in s_gb_dict:
-                u_dis = 10
-                for lu in l_gb_dict.get(lbu, []):
-                    for su in s_gb_dict.get(sbu, []):
-                        if Levenshtein.distance(lu, su) <= u_dis:
-                            u_dis = Levenshtein.distance(lu, su)
-                if u_dis <= 4:
-                    tmp_result[k] = u_dis
-        if tmp_result:
-            min_pair = min(tmp_result, key=tmp_result.get)
+        min_pair = umi_best_candidate(g, lb, sb_list, s_gb_dict, l_gb_dict)
+        if min_pair is not None:
             update_best_barcode_list(best_barcode_list, min_pair, multi_dict, lb, g)
 
 def process_wrong_barcode(wrong_barcode, lb, best_barcode_list, wrong_dict, s_gb_dict, l_gb_dict):
     for g, sb_list in wrong_barcode.items():
         sb_list.append(lb)
-        lbu = f"{g}_{lb}"
-        tmp_result = {}
-        for k in sb_list:
-            sbu = f"{g}_{k}"
-            if sbu in s_gb_dict:
-                u_dis = 10
-                for lu in l_gb_dict.get(lbu, []):
-                    for su in s_gb_dict.get(sbu, []):
-                        if Levenshtein.distance(lu, su) <= u_dis:
-                            u_dis = Levenshtein.distance(lu, su)
-                if u_dis <= 4:
-                    tmp_result[k] = u_dis
-        if tmp_result:
-            min_pair = min(tmp_result, key=tmp_result.get)
+        min_pair = umi_best_candidate(g, lb, sb_list, s_gb_dict, l_gb_dict)
+        if min_pair is not None:
             update_best_barcode_list(best_barcode_list, min_pair, wrong_dict, lb, g)
 
 def process_no_best_barcode(multiple_barcode, lb, best_barcode_dict, s_gb_dict, l_gb_dict):
     g_dict = {}
     for g, sb_list in multiple_barcode.items():
-        lbu = f"{g}_{lb}"
-        tmp_result = {}
-        for k in sb_list:
-            sbu = f"{g}_{k}"
-            if sbu in s_gb_dict:
-                u_dis = 10
-                for lu in l_gb_dict.get(lbu, []):
-                    for su in s_gb_dict.get(sbu, []):
-                        if Levenshtein.distance(lu, su) <= u_dis:
-                            u_dis = Levenshtein.distance(lu, su)
-                if u_dis <= 4:
-                    tmp_result[k] = u_dis
-        if tmp_result:
-            min_pair = min(tmp_result, key=tmp_result.get)
+        min_pair = umi_best_candidate(g, lb, sb_list, s_gb_dict, l_gb_dict)
+        if min_pair is not None:
             g_dict[g] = min_pair
 
     if g_dict:
@@ -233,80 +1188,285 @@ def update_best_barcode_list(best_barcode_list, min_pair, target_dict, lb, g):
         target_dict["{}_{}".format(g,lb)] = min_pair
 
 
-def main(gene_barcode_file, barcode_gene_file, s_umi_file,l_umi_file,batch_size, min_dis, max_workers, umi,output_dir):
+def write_batch_results(batch_index, outputs, output_dir, writer=None):
+    """写出单个批次 UMI 校正后的结果；给定 writer 时追加到流式输出"""
+    multi_dict, wrong_dict, best_barcode_dict = outputs
+    if writer is not None:
+        writer.write("multi_dict", multi_dict)
+        writer.write("wrong_dict", wrong_dict)
+        writer.write("best_dict", best_barcode_dict)
+        return
+    if multi_dict:
+        batch_multi_filename = f"barcode_multi_dict_batch_{batch_index}.json"
+        output_multi_path = os.path.join(output_dir, batch_multi_filename)
+        with open(output_multi_path, "w") as f:
+            json.dump(multi_dict, f, indent=4)
+    if wrong_dict:
+        batch_wrong_filename = f"barcode_wrong_dict_batch_{batch_index}.json"
+        output_wrong_path = os.path.join(output_dir, batch_wrong_filename)
+        with open(output_wrong_path, "w") as f:
+            json.dump(wrong_dict, f, indent=4)
+
+    if best_barcode_dict:
+        batch_filename = f"barcode_best_dict_batch_{batch_index}.json"
+        output_path = os.path.join(output_dir, batch_filename)
+        with open(output_path, "w") as f:
+            json.dump(best_barcode_dict, f, indent=4)
+
+
+def main(gene_barcode_file, barcode_gene_file, s_umi_file,l_umi_file,batch_size, min_dis, max_workers, umi,output_dir, engine="rapidfuzz", schedule="barcode",
+         batching="fixed", split_heavy=False, output_mode="batch", resume=False, stats_report=False,
+         result_cache=None, shard=None):
+    global COLLECT_STATS
+    COLLECT_STATS = stats_report
+    run_stats = RunStats()
+    main_start = time.perf_counter()
+    parent_counters = Counter(HOT_COUNTERS)
     try:
-        with open(gene_barcode_file) as f:
-            gene_barcode_data = json.load(f)
-        with open(barcode_gene_file) as f:
-            barcode_gene_data = json.load(f)
-        if umi=="true":
-            with open(l_umi_file) as f:
-                l_gb_dict=json.load(f)
-            with open(s_umi_file) as f:
-                s_gb_dict=json.load(f)
-        else:
-            l_gb_dict={}
-            s_gb_dict={}
+        with run_stats.stage("load"):
+            gene_barcode_data = load_barcode_dict(gene_barcode_file)
+            barcode_gene_data = load_barcode_dict(barcode_gene_file)
+            if umi=="true":
+                l_gb_dict=load_umi_dict(l_umi_file)
+                s_gb_dict=load_umi_dict(s_umi_file)
+            else:
+                l_gb_dict={}
+                s_gb_dict={}
     
     except (FileNotFoundError, json.JSONDecodeError) as e:
         print(f"Error loading data: {e}")
         exit(1)
 
+    if shard is not None:
+        barcode_gene_data = select_shard(barcode_gene_data, shard)
+        print(f"Shard {shard[0]}/{shard[1]}: {len(barcode_gene_data)} LRS barcodes")
+
     sorted_barcodes = sort_sequences_by_gene_count(barcode_gene_data)
     gene_counts = extract_genes(gene_barcode_data)
     sorted_genes = sort_genes_by_sequence_count(gene_counts)
 
-    batches = [sorted_barcodes[i:i + batch_size] for i in range(0, len(sorted_barcodes), batch_size)]
+    with run_stats.stage("schedule"):
+        piece_tasks = []
+        if batching == "cost":
+            batches, piece_tasks = make_cost_batches(barcode_gene_data, gene_barcode_data, batch_size, max_workers, split_heavy)
+        else:
+            batches = [sorted_barcodes[i:i + batch_size] for i in range(0, len(sorted_barcodes), batch_size)]
+
+    with run_stats.stage("checkpoint"):
+        input_files = {"gene_barcode_file": gene_barcode_file, "barcode_gene_file": barcode_gene_file}
+        if umi == "true":
+            input_files.update(s_umi_file=s_umi_file, l_umi_file=l_umi_file)
+        inputs = {name: file_fingerprint(path, content=shard is not None) for name, path in input_files.items()}
+    params = {"batch_size": batch_size, "min_dis": min_dis, "umi": umi, "engine": engine, "schedule": schedule,
+              "batching": batching, "split_heavy": split_heavy, "output_mode": output_mode,
+              "shard": list(shard) if shard is not None else None}
+    if batching == "cost":
+        # 按计算量切分时批次数依赖进程数
+        params["max_workers"] = max_workers
+    try:
+        checkpoint = Checkpoint(output_dir, inputs, params, resume)
+    except ValueError as e:
+        print(f"Error resuming: {e}")
+        exit(1)
+    if checkpoint.state["finished"] and all(os.path.exists(os.path.join(output_dir, name)) for name in OUTPUT_FILES.values()):
+        print(f"All batches already completed according to {checkpoint.path}")
+        return
+
+    # 拆分片段合并后作为最后一个批次，编号为 len(batches)
+    pending = [(i, batch) for i, batch in enumerate(batches) if not checkpoint.done(i)]
+    if checkpoint.done(len(batches)):
+        piece_tasks = []
+    if resume:
+        print(f"Resuming: {len(checkpoint.completed)} batches done, {len(pending) + bool(piece_tasks)} to run")
+    else:
+        # 全新运行时清理上次中断遗留的批次文件，避免被合并进结果
+        remove_batch_files(output_dir)
+
+    writer = None
+    if output_mode == "stream":
+        writer = StreamingResultWriter(output_dir, checkpoint.state["stream_offsets"] if resume else None)
+
+    def finish_batch(batch_index, outputs):
+        with run_stats.stage("write"):
+            write_batch_results(batch_index, outputs, output_dir, writer)
+            checkpoint.mark_completed(batch_index, writer.offsets() if writer is not None else None)
+
+    cache = None
+    if result_cache:
+        with run_stats.stage("result_cache"):
+            cache = ResultCache(result_cache, gene_barcode_data, min_dis)
+
+    def lookup_cache(batch):
+        if cache is None:
+            return {}, batch
+        with run_stats.stage("result_cache"):
+            return cache.lookup(batch)
 
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(process_batch, batch, gene_barcode_data, min_dis): i for i, batch in enumerate(batches)}
+    def store_cache(batch_results):
+        if cache is not None:
+            with run_stats.stage("result_cache"):
+                cache.store(batch_results, barcode_gene_data)
 
+    # 拆分片段中已有缓存结果的条形码不再提交
+    has_pieces = bool(piece_tasks)
+    heavy_barcodes = list(dict.fromkeys(pieces[0][0] for pieces in piece_tasks))
+    piece_hits, _ = lookup_cache([(l_barcode, barcode_gene_data[l_barcode]) for l_barcode in heavy_barcodes])
+    piece_tasks = [pieces for pieces in piece_tasks if pieces[0][0] not in piece_hits]
+
+    with make_executor(max_workers, gene_barcode_data, min_dis, engine, s_gb_dict, l_gb_dict, stats_report) as executor:
+        futures = {}
+        batch_seconds = {}
+        # 拆分的片段任务最重，先于普通批次提交
+        piece_futures = [executor.submit(process_worker_pieces, pieces) for pieces in piece_tasks]
+        if schedule == "gene":
+            lookups = {batch_index: lookup_cache(batch) for batch_index, batch in pending}
+            pending_barcode_gene = {l_barcode: l_gene_list for _, misses in lookups.values() for l_barcode, l_gene_list in misses}
+            with run_stats.stage("gene_distance"):
+                gene_hits, gene_stats, failed_genes = collect_gene_hits(executor, pending_barcode_gene, gene_barcode_data, min_dis,
+                                                                        batch_size, lpt=(batching == "cost"))
+            run_stats.add_worker(gene_stats)
+            for batch_index, batch in pending:
+                try:
+                    hits, misses = lookups.pop(batch_index)
+                    if any(l_gene in failed_genes for _, l_gene_list in misses for l_gene in l_gene_list):
+                        # 不组装、不写入缓存，--resume 时重跑
+                        print(f"Error processing batch {batch_index}: gene batch failed")
+                        checkpoint.mark_failed(batch_index)
+                        continue
+                    with run_stats.stage("assemble"):
+                        computed = assemble_batch_results(misses, gene_barcode_data, gene_hits)
+                    store_cache(computed)
+                    futures[executor.submit(process_worker_umi, ordered_results(batch, hits, computed))] = batch_index
+                except Exception as e:
+                    print(f"Error processing batch {batch_index}: {e}")
+                    checkpoint.mark_failed(batch_index)
+        elif cache is not None:
+            # 先在工作进程中计算未命中缓存的条形码，结果写入缓存后再提交 UMI 校正
+            distance_futures = {}
+            for batch_index, batch in pending:
+                hits, misses = lookup_cache(batch)
+                distance_futures[executor.submit(process_worker_distance, misses)] = (batch_index, batch, hits)
+            for future in as_completed(distance_futures):
+                batch_index, batch, hits = distance_futures[future]
+                try:
+                    computed, distance_stats = future.result()
+                    run_stats.add_worker(distance_stats)
+                    batch_seconds[batch_index] = distance_stats["time_distance"]
+                    store_cache(computed)
+                    futures[executor.submit(process_worker_umi, ordered_results(batch, hits, computed))] = batch_index
+                except Exception as e:
+                    print(f"Error processing batch {batch_index}: {e}")
+                    checkpoint.mark_failed(batch_index)
+        else:
+            futures = {executor.submit(process_worker_batch, batch): i for i, batch in pending}
+
+        # 父进程只收集 UMI 校正后的小结果并写出
         for future in as_completed(futures):
             batch_index = futures[future]
             try:
-                batch_results = future.result()
-                multi_dict, wrong_dict, best_barcode_dict = process_barcodes(batch_results, s_gb_dict, l_gb_dict)
-                if multi_dict:
-                    batch_multi_filename = f"barcode_multi_dict_batch_{batch_index}.json"
-                    output_multi_path = os.path.join(output_dir, batch_multi_filename)
-                    with open(output_multi_path, "w") as f:
-                        json.dump(multi_dict, f, indent=4)
-                if wrong_dict:
-                    batch_wrong_filename = f"barcode_wrong_dict_batch_{batch_index}.json"
-                    output_wrong_path = os.path.join(output_dir, batch_wrong_filename)
-                    with open(output_wrong_path, "w") as f:
-                        json.dump(wrong_dict, f, indent=4)
-                        
-                if best_barcode_dict:   
-                    batch_filename = f"barcode_best_dict_batch_{batch_index}.json"
-                    output_path = os.path.join(output_dir, batch_filename)
-                    with open(output_path, "w") as f:
-                        json.dump(best_barcode_dict, f, indent=4)
-
-                
+                outputs, batch_stats = future.result()
+                run_stats.add_worker(batch_stats)
+                run_stats.add_batch_latency(batch_seconds.get(batch_index, 0) + batch_stats.get("time_distance", 0)
+                                            + batch_stats.get("time_umi", 0))
+                finish_batch(batch_index, outputs)
+            except Exception as e:
+                print(f"Error processing batch {batch_index}: {e}")
+                checkpoint.mark_failed(batch_index)
+
+        if has_pieces:
+            batch_index = len(batches)
+            try:
+                piece_results = defaultdict(dict)
+                for future in piece_futures:
+                    pieces, piece_stats = future.result()
+                    run_stats.add_worker(piece_stats)
+                    run_stats.add_batch_latency(piece_stats.get("time_distance", 0))
+                    for l_barcode, partial in pieces:
+                        piece_results[l_barcode].update(partial)
+                with run_stats.stage("assemble"):
+                    batch_results = merge_gene_pieces(barcode_gene_data, piece_results)
+                store_cache(batch_results)
+                batch_results.update(piece_hits)
+                outputs, umi_stats = executor.submit(process_worker_umi, batch_results).result()
+                run_stats.add_worker(umi_stats)
+                finish_batch(batch_index, outputs)
             except Exception as e:
                 print(f"Error processing batch {batch_index}: {e}")
-                
-                
-    merge_path = os.path.join(output_dir, "barcode_best.json")           
-    merge_json_files(output_dir, merge_path,sep="best_dict")
-    merge_path = os.path.join(output_dir, "barcode_multi_dict.json")           
-    merge_json_files(output_dir, merge_path,sep="multi_dict")
-    merge_path = os.path.join(output_dir, "barcode_wrong_dict.json")           
-    merge_json_files(output_dir, merge_path,sep="wrong_dict")
+                checkpoint.mark_failed(batch_index)
+
+    if cache is not None:
+        run_stats.counters.update(cache.stats)
+        print(f"Result cache: hits={cache.stats['result_cache_hits']}, misses={cache.stats['result_cache_misses']}")
+        cache.close()
+
+    if engine == "cached" and schedule != "gene":
+        cache_keys = ("gene_hits", "gene_misses", "pair_hits", "pair_misses")
+        print("Distance cache: " + ", ".join(f"{k}={run_stats.counters[k]}" for k in cache_keys))
+
+    if checkpoint.state["failed"]:
+        # 保留批次文件和 .part 文件，使用 --resume 只重跑失败的批次
+        print(f"{len(checkpoint.state['failed'])} batches failed; rerun with --resume to retry them")
+        exit(1)
+
+    with run_stats.stage("merge"):
+        if writer is not None:
+            writer.close()
+        else:
+            merge_path = os.path.join(output_dir, "barcode_best.json")           
+            merge_json_files(output_dir, merge_path,sep="best_dict")
+            merge_path = os.path.join(output_dir, "barcode_multi_dict.json")           
+            merge_json_files(output_dir, merge_path,sep="multi_dict")
+            merge_path = os.path.join(output_dir, "barcode_wrong_dict.json")           
+            merge_json_files(output_dir, merge_path,sep="wrong_dict")
+    # 三个结果文件都写好后才标记完成并删除中间文件；在此之前中断，--resume 会重新合并
+    checkpoint.mark_finished()
+    if writer is not None:
+        writer.remove_parts()
+    else:
+        remove_batch_files(output_dir)
 
+    if stats_report:
+        # 父进程中执行的 calculate_result（基因模式、拆分片段）也计入统计
+        run_stats.counters.update(HOT_COUNTERS - parent_counters)
+        run_stats.stages["total"] = time.perf_counter() - main_start
+        print(f"Run statistics saved to {run_stats.write(output_dir, dict(params, max_workers=max_workers))}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Find the best matching barcode for each barcode gene.")
-    parser.add_argument("--gene-barcode-file", type=str, required=True, help="File path for gene to barcode mapping.")
-    parser.add_argument("--barcode-gene-file", type=str, required=True, help="File path for barcode to gene mapping.")
-    parser.add_argument("--s-umi-file", type=str, required=True, help="File path for srs umi mapping.")
-    parser.add_argument("--l-umi-file", type=str, required=True, help="File path for lrs umi mapping.")
+    parser.add_argument("--gene-barcode-file", type=str, required=True,
+                        help="File path for gene to barcode mapping (.json, or a .csr directory).")
+    parser.add_argument("--barcode-gene-file", type=str, required=True,
+                        help="File path for barcode to gene mapping (.json, or a .csr directory).")
+    parser.add_argument("--s-umi-file", type=str, required=True, help="File path for srs umi mapping (.json, or .sqlite / .packed directory for lazy lookups).")
+    parser.add_argument("--l-umi-file", type=str, required=True, help="File path for lrs umi mapping (.json, or .sqlite / .packed directory for lazy lookups).")
     parser.add_argument("--batch-size", type=int, default=5000, help="Batch size for processing.")
     parser.add_argument("--min-dis", type=int, default=8, help="Minimum distance for matching.")
     parser.add_argument("--max-workers", type=int, default=100, help="Maximum number of worker processes.")
     parser.add_argument("--umi", type=str, default="true", help="UMI adjust")
     parser.add_argument("--output-dir", type=str, required=True, help="Output directory for results.")
+    parser.add_argument("--engine", type=str, default="rapidfuzz", choices=["rapidfuzz", "packed", "cached"],
+                        help="Barcode distance engine: rapidfuzz (per pair), packed (2-bit packed, bit-parallel per gene) "
+                             "or cached (per pair, reusing distances shared between the genes of one LRS barcode).")
+    parser.add_argument("--schedule", type=str, default="barcode", choices=["barcode", "gene"],
+                        help="Split work by LRS barcode, or by gene with one bounded distance matrix per gene "
+                             "(gene mode always uses rapidfuzz cdist and ignores --engine).")
+    parser.add_argument("--batching", type=str, default="fixed", choices=["fixed", "cost"],
+                        help="Fixed-size batches, or batches of roughly equal estimated cost dispatched heaviest first.")
+    parser.add_argument("--split-heavy", action="store_true",
+                        help="With --batching cost, split barcodes heavier than one batch across several tasks by gene.")
+    parser.add_argument("--output-mode", type=str, default="batch", choices=["batch", "stream"],
+                        help="Write per-batch JSON files and merge them at the end, or stream compact results "
+                             "into one writer and concatenate them into the final files.")
+    parser.add_argument("--result-cache", type=str, default=None,
+                        help="SQLite file caching per-barcode matching results across runs; "
+                             "only barcodes whose genes or referenced SRS barcodes changed are recomputed.")
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="Process only shard i of N (0-based, written as i/N), selected by a stable hash of the "
+                             "LRS barcode; combine the shard output directories with merge_barcode_adjust_shards.py.")
+    parser.add_argument("--stats", action="store_true",
+                        help=f"Write stage timings, hot-path counters and a batch latency histogram to {STATS_FILE} in --output-dir.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume from the checkpoint in --output-dir: skip completed batches and retry failed ones.")
 
     args = parser.parse_args()
 
@@ -314,4 +1474,5 @@ if __name__ == "__main__":
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir, exist_ok=True)
 
-    main(args.gene_barcode_file, args.barcode_gene_file, args.s_umi_file,args.l_umi_file,args.batch_size, args.min_dis, args.max_workers,args.umi,args.output_dir)
\ No newline at end of file
+    main(args.gene_barcode_file, args.barcode_gene_file, args.s_umi_file,args.l_umi_file,args.batch_size, args.min_dis, args.max_workers,args.umi,args.output_dir,args.engine,args.schedule,
+         args.batching,args.split_heavy,args.output_mode,args.resume,args.stats,args.result_cache,args.shard)
\ No newline at end of file
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+@File    :   barcode_codec.py
+@Desc    :   Vectorized conversion between hexadecimal barcode ids, DNA strings and 2-bit packed integers
+"""
+
+import numpy as np
+
+
+NT = "ACGT"
+_NT_BYTES = np.frombuffer(NT.encode(), dtype=np.uint8)
+
+# Value of each hexadecimal ASCII character, -1 for any other byte
+_HEX_VALUES = np.full(256, -1, dtype=np.int8)
+for _value, _char in enumerate("0123456789abcdef"):
+    _HEX_VALUES[ord(_char)] = _value
+    _HEX_VALUES[ord(_char.upper())] = _value
+
+# 2-bit code of each nucleotide ASCII character, -1 for any other byte
+_NT_VALUES = np.full(256, -1, dtype=np.int8)
+for _value, _char in enumerate(NT):
+    _NT_VALUES[ord(_char)] = _value
+
+
+def numerical_to_dna(numerical_str, length):
+    """
+    Convert a hexadecimal numerical string to a DNA sequence.
+
+    Only the lowest 2 * length bits are used; this is the reference for hex_to_dna.
+
+    Parameters:
+    numerical_str (str): The hexadecimal numerical string.
+    length (int): The length of the DNA sequence to generate.
+
+    Returns:
+    str: The DNA sequence.
+    """
+    NT_COMP = {'0': 'A', '1': 'C', '2': 'G', '3': 'T'}
+    numerical = int(numerical_str, 16)  # Convert hex string to integer
+    dna = []
+
+    for _ in range(length):
+        numerical, remainder = divmod(numerical, 4)
+        dna.append(NT_COMP[str(remainder)])
+    dna = dna[::-1]  # Reverse the list to get the correct order
+    return ''.join(dna)
+
+
+def _byte_matrix(strings):
+    """
+    Return the strings as an (n, width) uint8 matrix right-aligned with '0' padding,
+    or None if any string is not ASCII.
+    """
+    strings = np.asarray(strings, dtype=str)
+    width = max(strings.dtype.itemsize // 4, 1)
+    try:
+        raw = np.char.rjust(strings, width, "0").astype(f"S{width}")
+    except UnicodeEncodeError:
+        return None
+    return np.frombuffer(raw.tobytes(), dtype=np.uint8).reshape(len(strings), width)
+
+
+def _as_byte_strings(byte_matrix):
+    """
+    View an (n, width) uint8 matrix as n byte strings of the given width.
+    """
+    return np.ascontiguousarray(byte_matrix).view(f"S{byte_matrix.shape[1]}").ravel()
+
+
+def hex_to_codes(ids, length):
+    """
+    Convert hexadecimal ids to 2-bit nucleotide codes (0-3 for A, C, G, T).
+
+    Parameters:
+    ids (sequence of str): Hexadecimal ids.
+    length (int): Number of nucleotides per id.
+
+    Returns:
+    np.ndarray: uint8 array of shape (len(ids), length), most significant nucleotide first.
+    """
+    ids = [str(i) for i in ids]
+    n_hex = (length + 1) // 2
+    codes = np.zeros((len(ids), 2 * n_hex), dtype=np.uint8)
+    if not ids:
+        return codes[:, codes.shape[1] - length:]
+
+    raw = _byte_matrix(ids)
+    if raw is None:
+        invalid = np.ones(len(ids), dtype=bool)
+    else:
+        values = _HEX_VALUES[raw]
+        invalid = (values < 0).any(axis=1) | (np.char.str_len(np.asarray(ids, dtype=str)) == 0)
+        if raw.shape[1] < n_hex:
+            values = np.pad(values, ((0, 0), (n_hex - raw.shape[1], 0)))
+        digits = values[:, -n_hex:].astype(np.uint8)
+        codes[:, 0::2] = digits >> 2
+        codes[:, 1::2] = digits & 3
+
+    # Anything int(..., 16) accepts besides plain hex digits (prefixes, signs, whitespace)
+    # goes through the reference implementation, which also raises the same errors.
+    for i in np.flatnonzero(invalid):
+        codes[i, 2 * n_hex - length:] = _NT_VALUES[np.frombuffer(numerical_to_dna(ids[i], length).encode(), dtype=np.uint8)]
+    return codes[:, 2 * n_hex - length:]
+
+
+def codes_to_dna(codes):
+    """
+    Convert a 2-bit code matrix from hex_to_codes or dna_to_codes to DNA strings.
+    """
+    codes = np.asarray(codes, dtype=np.uint8)
+    if codes.shape[1] == 0:
+        return [""] * codes.shape[0]
+    return _as_byte_strings(_NT_BYTES[codes]).astype(str).tolist()
+
+
+def hex_to_dna(ids, length):
+    """
+    Convert hexadecimal ids to DNA strings; element-wise identical to numerical_to_dna.
+
+    Parameters:
+    ids (sequence of str): Hexadecimal ids.
+    length (int): Length of each DNA sequence.
+
+    Returns:
+    list: DNA sequences.
+    """
+    return codes_to_dna(hex_to_codes(ids, length))
+
+
+def dna_to_codes(seqs):
+    """
+    Convert equal-length DNA strings (A, C, G, T only) to a 2-bit code matrix.
+    """
+    raw = _byte_matrix(seqs)
+    if raw is None or np.char.str_len(np.asarray(seqs, dtype=str)).min(initial=raw.shape[1]) != raw.shape[1]:
+        raise ValueError("DNA sequences must be ASCII and of equal length")
+    values = _NT_VALUES[raw]
+    if (values < 0).any():
+        raise ValueError("DNA sequences may only contain A, C, G and T")
+    return values.astype(np.uint8)
+
+
+def codes_to_packed(codes):
+    """
+    Pack a 2-bit code matrix of at most 32 columns into uint64 integers.
+    """
+    if codes.shape[1] > 32:
+        raise ValueError("At most 32 nucleotides fit into a uint64")
+    packed = np.zeros(codes.shape[0], dtype=np.uint64)
+    for column in codes.T:
+        packed = (packed << np.uint64(2)) | column.astype(np.uint64)
+    return packed
+
+
+def packed_to_codes(packed, length):
+    """
+    Unpack uint64 integers into a 2-bit code matrix with length columns.
+    """
+    packed = np.asarray(packed, dtype=np.uint64)
+    shifts = np.arange(2 * (length - 1), -1, -2, dtype=np.uint64)
+    return ((packed[:, None] >> shifts) & np.uint64(3)).astype(np.uint8)
+
+
+def hex_to_packed(ids, length):
+    """
+    Convert hexadecimal ids to uint64 integers holding length 2-bit nucleotides.
+    """
+    return codes_to_packed(hex_to_codes(ids, length))
+
+
+def dna_to_packed(seqs):
+    """
+    Convert equal-length DNA strings to uint64 integers (2 bits per nucleotide).
+    """
+    return codes_to_packed(dna_to_codes(seqs))
+
+
+def packed_to_dna(packed, length):
+    """
+    Convert uint64 integers back to DNA strings of the given length.
+    """
+    return codes_to_dna(packed_to_codes(packed, length))
+
+
+def dna_to_hex(seqs, width=None):
+    """
+    Convert equal-length DNA strings to lowercase hexadecimal ids, the reverse of hex_to_dna.
+
+    Parameters:
+    seqs (sequence of str): DNA sequences.
+    width (int): Number of hex digits, zero-padded (default: enough for the sequence length).
+
+    Returns:
+    list: Hexadecimal ids with hex_to_dna(ids, len(seq)) == seqs.
+    """
+    codes = dna_to_codes(seqs)
+    length = codes.shape[1]
+    n_hex = (length + 1) // 2
+    if width is None:
+        width = n_hex
+    codes = np.pad(codes, ((0, 0), (2 * n_hex - length, 0)))
+    digits = (codes[:, 0::2] << 2) | codes[:, 1::2]
+    hex_bytes = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)[digits]
+    ids = _as_byte_strings(hex_bytes).astype(str) if n_hex else np.full(codes.shape[0], "", dtype=str)
+    return np.char.rjust(ids, width, "0").tolist()
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+from itertools import product
+
+import barcode_adjust_gene as bag
+
+
+NT = "ACGT"
+
+
+# 生成合成数据
+def random_seq(rng, length):
+    return "".join(rng.choice(NT) for _ in range(length))
+
+
+def mutate_seq(rng, seq, error_rate):
+    """按每个碱基的错误率引入替换/插入/缺失，长度保持不变"""
+    seq = list(seq)
+    for i in range(len(seq)):
+        if rng.random() < error_rate:
+            op = rng.random()
+            if op < 0.6:
+                seq[i] = rng.choice(NT.replace(seq[i], ""))
+            elif op < 0.8:
+                del seq[i]
+                seq.append(rng.choice(NT))
+            else:
+                seq.insert(i, rng.choice(NT))
+                seq.pop()
+    return "".join(seq)
+
+
+def generate_dataset(n_srs, n_lrs, n_genes, genes_per_srs, genes_per_lrs, error_rate, umi_depth,
+                     barcode_len=20, umi_len=10, seed=0):
+    """生成与 generate_barcode_json / generate_umi_json 输出结构一致的合成数据"""
+    rng = random.Random(seed)
+    genes = [f"gene{i}" for i in range(n_genes)]
+    srs_barcodes = list(dict.fromkeys(random_seq(rng, barcode_len) for _ in range(n_srs)))
+
+    srs_genes = {s: rng.sample(genes, min(genes_per_srs, n_genes)) for s in srs_barcodes}
+    gene_barcode = {}
+    for s_barcode, s_gene_list in srs_genes.items():
+        for gene in s_gene_list:
+            gene_barcode.setdefault(gene, []).append(s_barcode)
+
+    barcode_gene = {}
+    source = {}
+    for _ in range(n_lrs):
+        s_barcode = rng.choice(srs_barcodes)
+        l_barcode = mutate_seq(rng, s_barcode, error_rate)
+        # 大部分基因来自对应的 SRS 条形码，其余随机
+        shared = srs_genes[s_barcode][:genes_per_lrs]
+        extra = rng.sample(genes, max(0, min(genes_per_lrs - len(shared), n_genes)))
+        barcode_gene[l_barcode] = list(dict.fromkeys(shared + extra))
+        source[l_barcode] = s_barcode
+
+    s_umi = {f"{g}_{s}": [random_seq(rng, umi_len) for _ in range(umi_depth)]
+             for g, s_list in gene_barcode.items() for s in s_list}
+    l_umi = {}
+    for l_barcode, l_gene_list in barcode_gene.items():
+        for gene in l_gene_list:
+            s_key = f"{gene}_{source[l_barcode]}"
+            umis = [mutate_seq(rng, u, error_rate) for u in s_umi.get(s_key, [])[:umi_depth // 2]]
+            l_umi[f"{gene}_{l_barcode}"] = umis + [random_seq(rng, umi_len) for _ in range(umi_depth - len(umis))]
+    return gene_barcode, barcode_gene, s_umi, l_umi
+
+
+def write_dataset(workdir, gene_barcode, barcode_gene, s_umi, l_umi):
+    paths = {
+        "gene_barcode_file": os.path.join(workdir, "s_gene_barcode_valid.json"),
+        "barcode_gene_file": os.path.join(workdir, "l_barcode_gene_valid.json"),
+        "s_umi_file": os.path.join(workdir, "srs_gene_barcode_umi.json"),
+        "l_umi_file": os.path.join(workdir, "lrs_gene_barcode_umi.json"),
+    }
+    for key, data in zip(paths, (gene_barcode, barcode_gene, s_umi, l_umi)):
+        with open(paths[key], "w") as f:
+            json.dump(data, f)
+    return paths
+
+
+# 计时
+def count_pairs(barcode_gene_items, gene_barcode):
+    """需要比较的 (LRS 条形码, SRS 条形码) 对数"""
+    return sum(bag.estimate_barcode_cost(l_gene_list, gene_barcode) for _, l_gene_list in barcode_gene_items)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def rates(seconds, n_barcodes, n_pairs):
+    return {
+        "seconds": round(seconds, 6),
+        "barcodes": n_barcodes,
+        "pairs": n_pairs,
+        "barcodes_per_sec": round(n_barcodes / seconds, 2) if seconds else None,
+        "pairs_per_sec": round(n_pairs / seconds, 2) if seconds else None,
+    }
+
+
+def bench_stages(gene_barcode, barcode_gene, s_umi, l_umi, engine, min_dis, sample_size):
+    """单进程计时 best_barcode、process_batch 与 process_barcodes"""
+    items = list(barcode_gene.items())[:sample_size]
+    n_pairs = count_pairs(items, gene_barcode)
+    matcher = bag.make_matcher(engine)
+
+    _, seconds = timed(lambda: [bag.best_barcode(item, gene_barcode, min_dis, matcher) for item in items])
+    stages = {"best_barcode": rates(seconds, len(items), n_pairs)}
+
+    batch_results, seconds = timed(bag.process_batch, items, gene_barcode, min_dis, engine)
+    stages["process_batch"] = rates(seconds, len(items), n_pairs)
+
+    _, seconds = timed(bag.process_barcodes, batch_results, s_umi, l_umi)
+    stages["process_barcodes"] = rates(seconds, len(items), n_pairs)
+    return stages
+
+
+def bench_main(paths, n_barcodes, n_pairs, min_dis, max_workers, batch_size, engine, workdir):
+    """端到端计时 main，每次使用独立的输出目录"""
+    output_dir = tempfile.mkdtemp(prefix=f"w{max_workers}_b{batch_size}_{engine}_", dir=workdir)
+    _, seconds = timed(bag.main, paths["gene_barcode_file"], paths["barcode_gene_file"], paths["s_umi_file"],
+                       paths["l_umi_file"], batch_size, min_dis, max_workers, "true", output_dir, engine)
+    return rates(seconds, n_barcodes, n_pairs)
+
+
+def parse_int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark barcode_adjust_gene.py on synthetic data.")
+    parser.add_argument("--n-srs", type=int, default=5000, help="Number of SRS barcodes.")
+    parser.add_argument("--n-lrs", type=int, default=5000, help="Number of LRS barcodes.")
+    parser.add_argument("--n-genes", type=int, default=2000, help="Number of genes.")
+    parser.add_argument("--genes-per-srs", type=int, default=50, help="Genes per SRS barcode.")
+    parser.add_argument("--genes-per-lrs", type=int, default=20, help="Genes per LRS barcode.")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="Per-base error rate of LRS barcodes and UMIs.")
+    parser.add_argument("--umi-depth", type=int, default=4, help="UMIs per gene-barcode pair.")
+    parser.add_argument("--min-dis", type=int, default=8, help="Minimum distance for matching.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic data.")
+    parser.add_argument("--engines", type=str, default="rapidfuzz,packed,cached", help="Comma-separated distance engines.")
+    parser.add_argument("--sample-size", type=int, default=1000, help="LRS barcodes timed in the single-process stages.")
+    parser.add_argument("--workers", type=parse_int_list, default=[1, 4, 16], help="Comma-separated worker counts for main.")
+    parser.add_argument("--batch-sizes", type=parse_int_list, default=[500, 5000], help="Comma-separated batch sizes for main.")
+    parser.add_argument("--workdir", type=str, default=None, help="Directory for synthetic inputs and outputs (default: temporary).")
+    parser.add_argument("--output", type=str, default="benchmark_barcode_adjust_gene.json", help="JSON file for the results.")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_barcode_adjust_")
+    os.makedirs(workdir, exist_ok=True)
+
+    dataset_params = {k: getattr(args, k) for k in
+                      ("n_srs", "n_lrs", "n_genes", "genes_per_srs", "genes_per_lrs", "error_rate", "umi_depth", "seed")}
+    (gene_barcode, barcode_gene, s_umi, l_umi), seconds = timed(generate_dataset, **dataset_params)
+    paths = write_dataset(workdir, gene_barcode, barcode_gene, s_umi, l_umi)
+    n_pairs = count_pairs(barcode_gene.items(), gene_barcode)
+    print(f"Generated {len(barcode_gene)} LRS barcodes, {n_pairs} pairs in {seconds:.1f}s under {workdir}")
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "dataset": dict(dataset_params, min_dis=args.min_dis, pairs=n_pairs),
+        "stages": {},
+        "main": [],
+    }
+
+    engines = [e for e in args.engines.split(",") if e]
+    for engine in engines:
+        stages = bench_stages(gene_barcode, barcode_gene, s_umi, l_umi, engine, args.min_dis, args.sample_size)
+        report["stages"][engine] = stages
+        for stage, result in stages.items():
+            print(f"{engine:>10} {stage:<17} {result['seconds']:>10.3f}s "
+                  f"{result['barcodes_per_sec']:>12} barcodes/s {result['pairs_per_sec']:>14} pairs/s")
+
+    for engine, max_workers, batch_size in product(engines, args.workers, args.batch_sizes):
+        result = bench_main(paths, len(barcode_gene), n_pairs, args.min_dis, max_workers, batch_size, engine, workdir)
+        report["main"].append(dict(result, engine=engine, max_workers=max_workers, batch_size=batch_size))
+        print(f"{engine:>10} main workers={max_workers:<4} batch={batch_size:<6} {result['seconds']:>10.3f}s "
+              f"{result['barcodes_per_sec']:>12} barcodes/s {result['pairs_per_sec']:>14} pairs/s")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+@File    :   chunked_matrix.py
+@Desc    :   Out-of-core processing of 10x matrix directories for generate_barcode_json --max_memory
+"""
+
+import os
+import gzip
+import logging
+import numpy as np
+import pandas as pd
+import anndata
+import h5py
+from anndata.utils import make_index_unique
+from scipy.sparse import coo_matrix, csr_matrix
+
+try:
+    from anndata.io import write_elem
+except ImportError:
+    from anndata.experimental import write_elem
+
+
+# Rough peak bytes per matrix entry while a chunk is parsed, bucketed and converted
+ENTRY_BYTES = 192
+
+_MEMORY_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_memory(value):
+    """
+    Parses a memory size such as 8G, 512M or a plain number of bytes.
+    """
+    value = str(value).strip().upper().rstrip("B")
+    if value and value[-1] in _MEMORY_UNITS:
+        return int(float(value[:-1]) * _MEMORY_UNITS[value[-1]])
+    return int(value)
+
+
+def current_rss():
+    """
+    Resident memory of this process in bytes (0 where /proc is not available).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def chunk_entries(max_memory):
+    """
+    Number of matrix entries handled at once under the given memory budget in bytes,
+    after the memory already in use (interpreter and libraries).
+    """
+    return max((max_memory - current_rss()) // ENTRY_BYTES, 1 << 16)
+
+
+def read_10x_dir(path):
+    """
+    Reads barcodes.tsv.gz and features.tsv.gz like _generate_adata and returns (obs, var, matrix.mtx.gz path).
+    """
+    if not os.path.isdir(path):
+        raise ValueError(f"Invalid path provided: {path}. Please provide a valid directory path.")
+
+    obs, var, mtx_path = None, None, None
+    for file in os.listdir(path):
+        file_path = os.path.join(path, file)
+        if file == "barcodes.tsv.gz":
+            obs = pd.read_csv(file_path, header=None, index_col=0, sep="\t")
+            obs.index.name = "barcode"
+        elif file == "features.tsv.gz":
+            var = pd.read_csv(file_path, header=None, index_col=0, sep="\t")
+            var.index.name = "gene"
+        elif file == "matrix.mtx.gz":
+            mtx_path = file_path
+
+    if obs is None or var is None or mtx_path is None:
+        raise ValueError("Missing one or more required files: barcodes.tsv.gz, features.tsv.gz, matrix.mtx.gz")
+    # AnnData stores names as strings and makes gene names unique
+    obs.index = obs.index.astype(str)
+    var.index = make_index_unique(var.index.astype(str))
+    return obs, var, mtx_path
+
+
+def _open_mtx(mtx_path):
+    """
+    Opens a MatrixMarket file after its header; returns (file, n_rows, n_cols, nnz, value dtype).
+    """
+    f = (gzip.open if mtx_path.endswith(".gz") else open)(mtx_path, "rb")
+    header = f.readline().decode().split()
+    if len(header) < 5 or header[2].lower() != "coordinate" or header[3].lower() not in ("integer", "real") \
+            or header[4].lower() != "general":
+        f.close()
+        raise ValueError(f"{mtx_path}: only coordinate integer/real general MatrixMarket files can be processed in chunks")
+    line = f.readline()
+    while line.startswith(b"%"):
+        line = f.readline()
+    n_rows, n_cols, nnz = (int(v) for v in line.split())
+    return f, n_rows, n_cols, nnz, np.int64 if header[3].lower() == "integer" else np.float64
+
+
+def iter_mtx_chunks(mtx_path, entries):
+    """
+    Yields (rows, cols, values) chunks of 0-based MatrixMarket triplets.
+    """
+    f, _, _, _, value_dtype = _open_mtx(mtx_path)
+    with f:
+        reader = pd.read_csv(f, sep=r"\s+", header=None, names=["row", "col", "value"], comment="%",
+                             dtype={"row": np.int32, "col": np.int32, "value": value_dtype}, chunksize=entries)
+        for chunk in reader:
+            yield chunk["row"].to_numpy() - 1, chunk["col"].to_numpy() - 1, chunk["value"].to_numpy()
+
+
+class DiskCSR:
+    """
+    Row-compressed matrix in a directory: indptr is kept in memory, indices and data
+    are flat binary files that are read by row range with plain file reads.
+    """
+
+    def __init__(self, path, shape, indptr, value_dtype):
+        self.path = path
+        self.shape = shape
+        self.indptr = indptr
+        self.dtype = np.dtype(value_dtype)
+        self.indices_path = os.path.join(path, "indices.bin")
+        self.data_path = os.path.join(path, "data.bin")
+        self._fd = None
+
+    def read_rows(self, start, stop, with_data=True):
+        """
+        Returns (indptr starting at 0, indices, data) of rows start..stop-1.
+        """
+        begin, end = int(self.indptr[start]), int(self.indptr[stop])
+        indices = np.fromfile(self.indices_path, dtype=np.int32, count=end - begin, offset=4 * begin)
+        data = np.fromfile(self.data_path, dtype=self.dtype, count=end - begin,
+                           offset=self.dtype.itemsize * begin) if with_data else None
+        return self.indptr[start:stop + 1] - begin, indices, data
+
+    def read_row_indices(self, row):
+        """
+        Returns the column indices of one row.
+        """
+        if self._fd is None:
+            self._fd = os.open(self.indices_path, os.O_RDONLY)
+        begin, end = int(self.indptr[row]), int(self.indptr[row + 1])
+        return np.frombuffer(os.pread(self._fd, 4 * (end - begin), 4 * begin), dtype=np.int32)
+
+    def row_chunks(self, entries):
+        """
+        Yields (start, stop) row ranges holding about entries entries (at least one row each).
+        """
+        start, n_rows = 0, self.shape[0]
+        while start < n_rows:
+            stop = int(np.searchsorted(self.indptr, self.indptr[start] + entries, side="right")) - 1
+            stop = min(max(stop, start + 1), n_rows)
+            yield start, stop
+            start = stop
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def build_disk_csr(mtx_path, path, by_column, entries):
+    """
+    Builds a DiskCSR from a MatrixMarket file without loading it.
+
+    by_column=True gives columns x rows of the file (cells x genes for 10x), False keeps
+    rows x columns (genes x cells). Entries are bucketed by target row range into
+    temporary files, then each bucket is sorted, duplicates summed and appended in order.
+
+    Returns (DiskCSR, positive entries per row, positive entries per column).
+    """
+    f, n_rows, n_cols, _, value_dtype = _open_mtx(mtx_path)
+    f.close()
+    shape = (n_cols, n_rows) if by_column else (n_rows, n_cols)
+    os.makedirs(path, exist_ok=True)
+
+    # Pass 1: entries per target row, then row ranges of at most `entries` entries each
+    counts = np.zeros(shape[0], dtype=np.int64)
+    for rows, cols, _ in iter_mtx_chunks(mtx_path, entries):
+        counts += np.bincount(cols if by_column else rows, minlength=shape[0])
+    cumulative = np.concatenate([[0], np.cumsum(counts)])
+    bounds = [0]
+    while bounds[-1] < shape[0]:
+        stop = int(np.searchsorted(cumulative, cumulative[bounds[-1]] + entries, side="right")) - 1
+        bounds.append(min(max(stop, bounds[-1] + 1), shape[0]))
+    bounds = np.array(bounds)
+
+    # Pass 2: append each chunk's entries to the file of their row range
+    record = np.dtype([("row", np.int32), ("col", np.int32), ("value", value_dtype)])
+    bucket_paths = [os.path.join(path, f"bucket_{i}.bin") for i in range(len(bounds) - 1)]
+    bucket_files = [open(bucket_path, "wb") for bucket_path in bucket_paths]
+    try:
+        for rows, cols, values in iter_mtx_chunks(mtx_path, entries):
+            target_rows, target_cols = (cols, rows) if by_column else (rows, cols)
+            bucket = np.searchsorted(bounds, target_rows, side="right") - 1
+            order = np.argsort(bucket, kind="stable")
+            chunk = np.empty(len(order), dtype=record)
+            chunk["row"], chunk["col"], chunk["value"] = target_rows[order], target_cols[order], values[order]
+            splits = np.searchsorted(bucket[order], np.arange(1, len(bucket_files)))
+            for bucket_file, part in zip(bucket_files, np.split(chunk, splits)):
+                part.tofile(bucket_file)
+    finally:
+        for bucket_file in bucket_files:
+            bucket_file.close()
+
+    # Pass 3: canonical CSR rows per bucket, appended to the final files
+    indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+    row_positive = np.zeros(shape[0], dtype=np.int64)
+    col_positive = np.zeros(shape[1], dtype=np.int64)
+    with open(os.path.join(path, "indices.bin"), "wb") as indices_file, open(os.path.join(path, "data.bin"), "wb") as data_file:
+        for i, bucket_path in enumerate(bucket_paths):
+            start, stop = bounds[i], bounds[i + 1]
+            chunk = np.fromfile(bucket_path, dtype=record)
+            os.remove(bucket_path)
+            block = coo_matrix((chunk["value"], (chunk["row"] - start, chunk["col"])), shape=(stop - start, shape[1])).tocsr()
+            del chunk
+            block.sort_indices()
+            block.indices.astype(np.int32).tofile(indices_file)
+            block.data.astype(value_dtype).tofile(data_file)
+            indptr[start + 1:stop + 1] = indptr[start] + block.indptr[1:]
+            positive = block.data > 0
+            block_rows = np.repeat(np.arange(stop - start), np.diff(block.indptr))
+            row_positive[start:stop] = np.bincount(block_rows[positive], minlength=stop - start)
+            col_positive += np.bincount(block.indices[positive], minlength=shape[1])
+    return DiskCSR(path, shape, indptr, value_dtype), row_positive, col_positive
+
+
+def write_h5ad_chunked(h5ad_path, store, obs, var, row_mask, col_mask, entries):
+    """
+    Writes the rows row_mask and columns col_mask of a cells x genes DiskCSR as an h5ad file, one row chunk at a time.
+
+    X is written as an anndata csr_matrix group with explicitly chunked, resizable datasets.
+    """
+    shape = (int(row_mask.sum()), int(col_mask.sum()))
+    anndata.AnnData(X=csr_matrix((0, shape[1]), dtype=store.dtype), obs=obs.iloc[:0], var=var).write_h5ad(h5ad_path)
+    with h5py.File(h5ad_path, "a") as f:
+        del f["X"]
+        group = f.create_group("X")
+        group.attrs.update({"encoding-type": "csr_matrix", "encoding-version": "0.1.0", "shape": shape})
+        data = group.create_dataset("data", shape=(0,), maxshape=(None,), dtype=store.dtype, chunks=(1 << 16,))
+        indices = group.create_dataset("indices", shape=(0,), maxshape=(None,), dtype=np.int32, chunks=(1 << 16,))
+        indptr = group.create_dataset("indptr", shape=(shape[0] + 1,), dtype=np.int64)
+        indptr[0] = 0
+        row, nnz = 0, 0
+        for start, stop in store.row_chunks(entries):
+            chunk_indptr, chunk_indices, chunk_data = store.read_rows(start, stop)
+            block = csr_matrix((chunk_data, chunk_indices, chunk_indptr), shape=(stop - start, store.shape[1]))
+            block = block[row_mask[start:stop]][:, col_mask]
+            if not block.shape[0]:
+                continue
+            data.resize((nnz + block.nnz,))
+            indices.resize((nnz + block.nnz,))
+            data[nnz:] = block.data
+            indices[nnz:] = block.indices
+            indptr[row + 1:row + 1 + block.shape[0]] = nnz + block.indptr[1:]
+            row, nnz = row + block.shape[0], nnz + block.nnz
+        del f["obs"]
+        write_elem(f, "obs", obs)
+
+
+def _iter_gene_barcodes(store, gene_mask, var_names, cell_mask, cell_names, entries):
+    """
+    Yields (gene, barcodes with a non-zero value) from a genes x cells DiskCSR, in gene and cell order.
+    """
+    for start, stop in store.row_chunks(entries):
+        indptr, indices, data = store.read_rows(start, stop)
+        for k in np.flatnonzero(gene_mask[start:stop]):
+            cols = indices[indptr[k]:indptr[k + 1]]
+            cols = cols[(data[indptr[k]:indptr[k + 1]] != 0) & cell_mask[cols]]
+            yield var_names[start + k], cell_names[cols].tolist()
+
+
+def _iter_barcode_genes(store, row_mask, gene_mask, obs_names, var_names, path, entries):
+    """
+    Yields (barcode, genes with a non-zero value) from a cells x genes DiskCSR.
+
+    Matches inverting the gene -> barcodes mapping: barcodes ordered by their first
+    non-zero gene, genes of rows sharing a barcode merged in gene order.
+    """
+    # Kept entries only, written to a second store read back one row at a time
+    os.makedirs(path, exist_ok=True)
+    indptr = np.zeros(store.shape[0] + 1, dtype=np.int64)
+    first_cols = np.full(store.shape[0], -1, dtype=np.int64)
+    with open(os.path.join(path, "indices.bin"), "wb") as indices_file:
+        for start, stop in store.row_chunks(entries):
+            chunk_indptr, indices, data = store.read_rows(start, stop)
+            entry_rows = np.repeat(np.arange(start, stop), np.diff(chunk_indptr))
+            keep = (data != 0) & gene_mask[indices] & row_mask[entry_rows]
+            indices, entry_rows = indices[keep], entry_rows[keep]
+            indices.tofile(indices_file)
+            counts = np.bincount(entry_rows - start, minlength=stop - start)
+            indptr[start + 1:stop + 1] = indptr[start] + np.cumsum(counts)
+            rows = np.flatnonzero(counts)
+            first_cols[start + rows] = indices[(indptr[start + rows] - indptr[start])]
+    kept = DiskCSR(path, store.shape, indptr, np.int32)
+
+    # A barcode first appears at its smallest non-zero column when scanning column by column
+    rows = np.flatnonzero(first_cols >= 0)
+    rows = rows[np.lexsort((rows, first_cols[rows]))]
+    del first_cols
+    rows_by_barcode = {}
+    for i in rows.tolist():
+        rows_by_barcode.setdefault(obs_names[i], []).append(i)
+    del rows
+
+    try:
+        for barcode, barcode_rows in rows_by_barcode.items():
+            if len(barcode_rows) == 1:
+                columns = kept.read_row_indices(barcode_rows[0]).tolist()
+            else:
+                columns = sorted((j, i) for i in barcode_rows for j in kept.read_row_indices(i).tolist())
+                columns = [j for j, _ in columns]
+            yield barcode, [var_names[j] for j in columns]
+    finally:
+        kept.close()
+
+
+def chunked_dictionaries(lrs_rawmtx_path, srs_rawmtx_path, workdir, max_memory, rename_lrs, rename_srs=None,
+                         min_genes=None, h5ad_dir=None):
+    """
+    Out-of-core equivalent of the AnnData steps of generate_json.
+
+    The matrices are converted to DiskCSR stores under workdir and then read in row
+    chunks of about max_memory bytes; filter_genes(min_cells=1), filter_cells(min_genes=1),
+    the min_genes trust filter and the common-gene subset are applied as masks.
+
+    Returns (trust barcode dict or None, gene -> SRS barcodes items, LRS barcode -> genes items);
+    the two item iterators read from workdir and must be consumed before it is removed.
+    """
+    entries = chunk_entries(max_memory)
+
+    logging.info("Building on-disk LRS matrix...")
+    l_obs, l_var, l_mtx = read_10x_dir(lrs_rawmtx_path)
+    l_store, l_n_genes, l_n_cells = build_disk_csr(l_mtx, os.path.join(workdir, "lrs"), True, entries)
+    l_cells, l_genes = l_n_genes >= 1, l_n_cells >= 1
+
+    logging.info("Building on-disk SRS matrix...")
+    s_obs, s_var, s_mtx = read_10x_dir(srs_rawmtx_path)
+    s_store, s_n_cells, s_n_genes = build_disk_csr(s_mtx, os.path.join(workdir, "srs_by_gene"), False, entries)
+    s_cells, s_genes = s_n_genes >= 1, s_n_cells >= 1
+
+    if h5ad_dir is not None:
+        logging.info("Writing h5ad files in chunks...")
+        obs = l_obs[l_cells].assign(n_genes=l_n_genes[l_cells])
+        var = l_var[l_genes].assign(n_cells=l_n_cells[l_genes])
+        write_h5ad_chunked(f"{h5ad_dir}/lrs.h5ad", l_store, obs, var, l_cells, l_genes, entries)
+        s_cell_store, _, _ = build_disk_csr(s_mtx, os.path.join(workdir, "srs"), True, entries)
+        obs = s_obs[s_cells].assign(n_genes=s_n_genes[s_cells])
+        var = s_var[s_genes].assign(n_cells=s_n_cells[s_genes])
+        write_h5ad_chunked(f"{h5ad_dir}/srs.h5ad", s_cell_store, obs, var, s_cells, s_genes, entries)
+
+    logging.info("Modifying barcode indices...")
+    l_names = np.asarray(rename_lrs(l_obs.index), dtype=str)
+    s_names = np.asarray(rename_srs(s_obs.index) if rename_srs is not None else s_obs.index.astype(str), dtype=str)
+    del l_obs, s_obs
+
+    logging.info("Filtering barcodes based on min_genes...")
+    trust_dict = None
+    l_rows = l_cells
+    if min_genes is not None:
+        trust = np.unique(l_names[l_cells & (l_n_genes >= min_genes)])
+        trust_dict = {i: i for i in trust.tolist()}
+        l_rows = l_cells & ~np.isin(l_names, trust)
+
+    logging.info("Filtering genes and generating dictionaries...")
+    gene_list = list(set(s_var.index[s_genes]) & set(l_var.index[l_genes]))
+    s_gene_mask = s_genes & s_var.index.isin(gene_list)
+    l_gene_mask = l_genes & l_var.index.isin(gene_list)
+
+    s_items = _iter_gene_barcodes(s_store, s_gene_mask, s_var.index.tolist(), s_cells, s_names, entries)
+    l_items = _iter_barcode_genes(l_store, l_rows, l_gene_mask, l_names.tolist(), l_var.index.tolist(),
+                                  os.path.join(workdir, "lrs_kept"), entries)
+    return trust_dict, s_items, l_items
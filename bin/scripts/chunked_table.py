@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+@File    :   chunked_table.py
+@Desc    :   Group-by (in memory or out of core) and writers of "id umi gene" read tables for generate_umi_json
+"""
+
+import os
+import gc
+import json
+import heapq
+import logging
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from barcode_codec import codes_to_packed, dna_to_codes
+
+
+COLUMNS = ["id", "umi", "gene", "gb"]
+
+
+def dump_json_items(items, f):
+    """
+    Writes (key, value) pairs one at a time, byte-identical to json.dump(dict(items), f).
+    """
+    f.write("{")
+    for i, (key, value) in enumerate(items):
+        if i:
+            f.write(", ")
+        f.write(json.dumps(key) + ": " + json.dumps(value))
+    f.write("}")
+
+
+def acgt_mask(umis, length=None):
+    """
+    Marks the UMIs that are non-empty A/C/G/T strings of the given length (at most 32).
+
+    Returns:
+    tuple: (boolean mask, length); length defaults to the most common length of the A/C/G/T UMIs, or None.
+    """
+    umis = np.asarray(umis, dtype=str)
+    if not len(umis):
+        return np.zeros(0, dtype=bool), length
+    chars = umis.view(np.uint32).reshape(len(umis), -1)
+    lengths = np.char.str_len(umis)
+    # Shorter strings are padded with NUL characters
+    valid = np.isin(chars, [0] + [ord(nt) for nt in "ACGT"]).all(axis=1) & (lengths > 0) & (lengths <= 32)
+    if length is None and valid.any():
+        length = int(np.bincount(lengths[valid]).argmax())
+    return valid & (lengths == length), length
+
+
+def save_packed_umis(items, path, batch_size=1 << 20):
+    """
+    Saves (gb, UMI list) pairs as a directory of memory-mappable .npy files with 2-bit packed UMIs.
+
+    keys.npy holds the keys (bytes if ASCII) and row i is umis[indptr[i]:indptr[i + 1]], the
+    key's UMIs packed by barcode_codec.dna_to_packed, sorted and deduplicated; umi_length.npy
+    holds the UMI length. Only A/C/G/T strings of one length (at most 32; the most common one
+    in the first batch) can be packed. Any other UMI, e.g. one containing N, is kept as a string
+    in extra_umis[extra_indptr[i]:extra_indptr[i + 1]], sorted and deduplicated; these two files
+    are only written when such UMIs exist. Rows are packed in batches of about batch_size UMIs.
+    """
+    keys, indptr, umis = [], [np.zeros(1, dtype=np.int64)], []
+    extra_indptr, extra_umis = [np.zeros(1, dtype=np.int64)], []
+    length = None
+    batch_keys, batch_umis, batch_count = [], [], 0
+
+    def flush():
+        nonlocal length
+        sizes = np.fromiter(map(len, batch_umis), dtype=np.int64, count=len(batch_umis))
+        flat = [umi for values in batch_umis for umi in values]
+        valid, length = acgt_mask(flat, length)
+        rows = np.repeat(np.arange(len(batch_umis)), sizes)
+        row = rows[valid]
+        if len(row):
+            packed = codes_to_packed(dna_to_codes([umi for umi, ok in zip(flat, valid.tolist()) if ok]))
+        else:
+            packed = np.zeros(0, dtype=np.uint64)
+        order = np.lexsort((packed, row))
+        row, packed = row[order], packed[order]
+        keep = np.r_[True, (row[1:] != row[:-1]) | (packed[1:] != packed[:-1])][:len(row)]
+        counts = np.bincount(row[keep], minlength=len(batch_umis))
+        indptr.append(indptr[-1][-1] + np.cumsum(counts))
+        umis.append(packed[keep])
+
+        extras = [set() for _ in batch_umis]
+        for i in np.flatnonzero(~valid).tolist():
+            extras[rows[i]].add(str(flat[i]))
+        extra_indptr.append(extra_indptr[-1][-1] + np.cumsum([len(values) for values in extras], dtype=np.int64))
+        for values in extras:
+            extra_umis.extend(sorted(values))
+
+        keys.extend(batch_keys)
+        batch_keys.clear()
+        batch_umis.clear()
+
+    for key, values in items:
+        batch_keys.append(key)
+        batch_umis.append(values)
+        batch_count += len(values)
+        if batch_count >= batch_size:
+            flush()
+            batch_count = 0
+    if batch_keys:
+        flush()
+
+    os.makedirs(path, exist_ok=True)
+    try:
+        # ASCII keys take a quarter of the space as bytes
+        keys = np.array(keys, dtype=bytes)
+    except UnicodeEncodeError:
+        keys = np.array(keys, dtype=str)
+    np.save(os.path.join(path, "keys.npy"), keys)
+    np.save(os.path.join(path, "indptr.npy"), np.concatenate(indptr))
+    # Smallest unsigned type holding 2 bits per nucleotide, e.g. uint32 for 10-16 nt UMIs
+    dtype = next(t for t in (np.uint8, np.uint16, np.uint32, np.uint64) if 4 * np.dtype(t).itemsize >= (length or 0))
+    np.save(os.path.join(path, "umis.npy"), np.concatenate(umis).astype(dtype) if umis else np.zeros(0, dtype=dtype))
+    np.save(os.path.join(path, "umi_length.npy"), np.int64(length or 0))
+    for name in ("extra_indptr.npy", "extra_umis.npy"):
+        if os.path.exists(os.path.join(path, name)):
+            os.remove(os.path.join(path, name))
+    if extra_umis:
+        np.save(os.path.join(path, "extra_indptr.npy"), np.concatenate(extra_indptr))
+        np.save(os.path.join(path, "extra_umis.npy"), np.array(extra_umis, dtype=str))
+        packable = f"A/C/G/T strings of length {length}" if length else "A/C/G/T strings"
+        logging.info(f"Stored {len(extra_umis)} UMIs that are not {packable} unpacked in {path}.")
+
+
+def group_umis(data):
+    """
+    Groups the "umi" column by "gb" like data.groupby("gb")["umi"].agg(list).items(), with one
+    stable sort instead of per-group aggregation (also fast for categorical columns).
+
+    Returns:
+    list: (gb, list of UMIs) pairs sorted by gb, UMIs in input order.
+    """
+    data = data.dropna(subset=["gb"])
+    if not len(data):
+        return []
+    # Sorting fixed-width numpy strings is several times faster than sorting Python objects
+    order = np.argsort(data["gb"].to_numpy().astype(str), kind="stable")
+    gb = data["gb"].to_numpy()[order]
+    umi = data["umi"].to_numpy()[order]
+    starts = np.flatnonzero(np.r_[True, gb[1:] != gb[:-1]])
+    stops = np.r_[starts[1:], len(gb)]
+    umi = umi.tolist()
+    # Millions of new lists would otherwise trigger repeated full garbage collections
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return list(zip(gb[starts].tolist(), [umi[start:stop] for start, stop in zip(starts.tolist(), stops.tolist())]))
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def partition_table(path, workdir, annotate, n_partitions, chunk_size):
+    """
+    Streams the space-separated table in chunks of chunk_size rows and appends each row to
+    one of n_partitions spill files chosen by a stable hash of its "gb" key.
+
+    annotate(data) adds the "barcode" and "gb" columns to a chunk. All values are read as
+    strings so that every chunk is parsed the same way; rows keep their input order within
+    each partition, so duplicates of a row always meet in the same file in order.
+
+    Returns:
+    list: Paths of the spill files.
+    """
+    paths = [os.path.join(workdir, f"part_{i:04d}.txt") for i in range(n_partitions)]
+    handles = [open(p, "w") for p in paths]
+    n_rows = 0
+    try:
+        for chunk in pd.read_csv(path, sep=" ", header=None, dtype=str, chunksize=chunk_size):
+            chunk = annotate(chunk.rename(columns={0: "id", 1: "umi", 2: "gene"}))
+            part = pd.util.hash_pandas_object(chunk["gb"], index=False).to_numpy() % np.uint64(n_partitions)
+            for i, rows in chunk[COLUMNS].groupby(part, sort=False):
+                rows.to_csv(handles[i], sep=" ", header=False, index=False)
+            n_rows += len(chunk)
+    finally:
+        for f in handles:
+            f.close()
+    logging.info(f"Partitioned {n_rows} rows of {path} into {n_partitions} spill files.")
+    return paths
+
+
+def aggregate_partition(path):
+    """
+    Deduplicates one spill file like drop_duplicates on (id, umi, gene), groups the UMIs by
+    "gb" in input order and writes the groups sorted by key as JSON lines next to it.
+
+    Returns:
+    str: Path of the sorted JSON lines file.
+    """
+    sorted_path = path[:-len(".txt")] + ".jsonl"
+    with open(sorted_path, "w") as out:
+        if os.path.getsize(path):
+            data = pd.read_csv(path, sep=" ", header=None, names=COLUMNS, dtype=str)
+            for gb, umi in group_umis(data.drop_duplicates(subset=["id", "umi", "gene"])):
+                out.write(json.dumps([gb, umi]) + "\n")
+    os.remove(path)
+    return sorted_path
+
+
+def _read_groups(path):
+    with open(path) as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+
+def grouped_umis(path, workdir, annotate, n_partitions=64, chunk_size=1_000_000, workers=1):
+    """
+    Out-of-core equivalent of process_data followed by groupby("gb").agg({"umi": list}).
+
+    Partitions are aggregated independently, in parallel with workers > 1, and merged back
+    into one stream so only one group per partition is held in memory at a time.
+
+    Yields:
+    tuple: (gb, list of UMIs) sorted by gb.
+    """
+    paths = partition_table(path, workdir, annotate, n_partitions, chunk_size)
+    if workers > 1:
+        mp_context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+            sorted_paths = list(executor.map(aggregate_partition, paths))
+    else:
+        sorted_paths = [aggregate_partition(p) for p in paths]
+    yield from heapq.merge(*(_read_groups(p) for p in sorted_paths), key=lambda item: item[0])
@@ -8,64 +8,186 @@
 """
 
 import os
+import tempfile
+import hashlib
+import numpy as np
+import scipy
 import scanpy as sc
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, csc_matrix
 from scipy.io import mmread
 import pandas as pd
 import json
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
+from barcode_codec import hex_to_dna
+from chunked_matrix import _open_mtx, chunked_dictionaries, iter_mtx_chunks, parse_memory
+from chunked_table import dump_json_items
+
+
+# scipy >= 1.12 parses MatrixMarket files with the multithreaded fast_matrix_market reader
+FAST_MMREAD = tuple(int(v) for v in scipy.__version__.split(".")[:2]) >= (1, 12)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 
-def _numerical_to_dna(numerical_str, length):
+def _sparse_matrix(adata, matrix_type):
     """
-    Convert numerical string to DNA sequence.
+    Returns adata.X as a csr_matrix or csc_matrix copy with sorted indices and no stored zeros.
     """
-    NT_COMP = {'0': 'A', '1': 'C', '2': 'G', '3': 'T'}
-    numerical = int(numerical_str, 16)  # Convert hex string to integer
-    dna = []
-
-    for _ in range(length):
-        numerical, remainder = divmod(numerical, 4)
-        dna.append(NT_COMP[str(remainder)])
-    dna = dna[::-1]  # Reverse the list to get the correct order
-    return ''.join(dna)
+    matrix = matrix_type(adata.X, copy=True)
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    return matrix
 
 
 def _filter_non_zero_indices(adata, batch_size=2000):
     """
-    Filters non-zero indices for each column in a DataFrame.
+    Yields (column (gene), rows (barcodes) with a non-zero value) pairs, in row order.
+
+    The rows are read from the CSC indptr/indices arrays, so no dense slice is built;
+    batch_size bounds how many columns are converted to name lists at a time.
     """
-    result = {}
+    matrix = _sparse_matrix(adata, csc_matrix)
+    obs_names = adata.obs_names.to_numpy()
+    var_names = adata.var_names.tolist()
 
     for j in range(0, adata.shape[1], batch_size):
-        data = adata[:, j:j + batch_size].to_df()
-        result.update({col: data.index[data[col] != 0].tolist() for col in data.columns})
-        del data
+        stop = min(j + batch_size, adata.shape[1])
+        rows = obs_names[matrix.indices[matrix.indptr[j]:matrix.indptr[stop]]].tolist()
+        offsets = matrix.indptr[j:stop + 1] - matrix.indptr[j]
+        for k in range(stop - j):
+            yield var_names[j + k], rows[offsets[k]:offsets[k + 1]]
+
+
+def _invert_dict(adata):
+    """
+    Yields (row (barcode), columns (genes) with a non-zero value) pairs.
 
-    return result
+    Built from the CSR rows; keys and gene order match inverting the
+    _filter_non_zero_indices result, including rows sharing a barcode.
+    """
+    matrix = _sparse_matrix(adata, csr_matrix)
+    obs_names = adata.obs_names.tolist()
+    var_names = adata.var_names.tolist()
+    indptr, indices = matrix.indptr, matrix.indices
+
+    # A barcode first appears at its smallest non-zero column when scanning column by column
+    rows = np.flatnonzero(np.diff(indptr))
+    rows = rows[np.lexsort((rows, indices[indptr[rows]]))]
+    rows_by_barcode = {}
+    for i in rows.tolist():
+        rows_by_barcode.setdefault(obs_names[i], []).append(i)
+
+    for barcode, barcode_rows in rows_by_barcode.items():
+        if len(barcode_rows) == 1:
+            i = barcode_rows[0]
+            columns = indices[indptr[i]:indptr[i + 1]].tolist()
+        else:
+            columns = sorted((j, i) for i in barcode_rows for j in indices[indptr[i]:indptr[i + 1]].tolist())
+            columns = [j for j, _ in columns]
+        yield barcode, [var_names[j] for j in columns]
+
+
+def _save_csr(items, path):
+    """
+    Saves (key, string list) pairs as a directory of memory-mappable .npy files.
+
+    keys.npy holds the row names (dictionary keys), names.npy the interned value
+    table, and row i lists names[indices[indptr[i]:indptr[i + 1]]] in order.
+    """
+    keys, names, indptr, indices = [], {}, [0], []
+    for key, values in items:
+        keys.append(key)
+        indices.append(np.fromiter((names.setdefault(value, len(names)) for value in values), dtype=np.int32, count=len(values)))
+        indptr.append(indptr[-1] + len(values))
 
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "keys.npy"), np.array(keys, dtype=str))
+    np.save(os.path.join(path, "names.npy"), np.array(list(names), dtype=str))
+    np.save(os.path.join(path, "indptr.npy"), np.array(indptr, dtype=np.int64))
+    np.save(os.path.join(path, "indices.npy"), np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32))
 
-def _invert_dict(data):
+
+def _save_dict(items, outdir, name, output_format):
     """
-    Inverts a dictionary where values are lists.
+    Streams (key, value) pairs to {name}.json or to a {name}.csr directory.
     """
-    transformed_data = {}
-    for key, values in data.items():
-        for value in values:
-            if value not in transformed_data:
-                transformed_data[value] = []
-            transformed_data[value].append(key)
-    return transformed_data
+    if output_format == "csr":
+        _save_csr(items, f'{outdir}/{name}.csr')
+    else:
+        with open(f'{outdir}/{name}.json', 'w') as f:
+            dump_json_items(items, f)
+
 
+def _read_mtx(file_path, chunk_size=5_000_000):
+    """
+    Reads a (gzipped) MatrixMarket file as a cells x genes csr_matrix, like csr_matrix(mmread(file_path).T).
 
-def _generate_adata(path, outdir, sample_type):
+    With an older scipy, whose mmread is a slow pure-Python parser, coordinate integer/real
+    general files are parsed in chunks with the pandas C parser into compact arrays;
+    otherwise mmread is used.
+    """
+    if FAST_MMREAD:
+        return csr_matrix(mmread(file_path).T)
+    try:
+        f, n_rows, n_cols, nnz, value_dtype = _open_mtx(file_path)
+    except ValueError:
+        # Array, pattern or symmetric MatrixMarket files are left to mmread
+        return csr_matrix(mmread(file_path).T)
+    f.close()
+
+    rows = np.empty(nnz, dtype=np.int32)
+    cols = np.empty(nnz, dtype=np.int32)
+    values = np.empty(nnz, dtype=value_dtype)
+    start = 0
+    for chunk_rows, chunk_cols, chunk_values in iter_mtx_chunks(file_path, chunk_size):
+        stop = start + len(chunk_rows)
+        rows[start:stop] = chunk_rows
+        cols[start:stop] = chunk_cols
+        values[start:stop] = chunk_values
+        start = stop
+    if start != nnz:
+        raise ValueError(f"{file_path} declares {nnz} entries but contains {start}")
+
+    # MatrixMarket is genes x cells; transpose while building the matrix
+    return csr_matrix((values, (cols, rows)), shape=(n_cols, n_rows))
+
+
+def _load_mtx(file_path, cache_dir=None):
+    """
+    Loads matrix.mtx.gz, reusing a parsed CSR cached in cache_dir while the file size and mtime are unchanged.
+    """
+    if cache_dir is None:
+        return _read_mtx(file_path)
+
+    abs_path = os.path.abspath(file_path)
+    stat = os.stat(abs_path)
+    source = f"{abs_path}\t{stat.st_size}\t{stat.st_mtime_ns}"
+    cache_path = os.path.join(cache_dir, hashlib.sha1(abs_path.encode()).hexdigest() + ".npz")
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            if str(cached["source"]) == source:
+                logging.info(f"Using cached matrix for {file_path}")
+                return csr_matrix((cached["data"], cached["indices"], cached["indptr"]), shape=tuple(cached["shape"]))
+
+    mtx = _read_mtx(file_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path + ".tmp.npz"
+    np.savez(tmp_path, data=mtx.data, indices=mtx.indices, indptr=mtx.indptr, shape=np.array(mtx.shape),
+             source=np.array(source))
+    os.replace(tmp_path, cache_path)
+    return mtx
+
+
+def _generate_adata(path, outdir, sample_type, mtx_cache_dir=None, submit=None):
     """
     Generates an AnnData object from the input directory path.
+
+    The {sample_type}.h5ad file is handed to submit (a background writer) when given,
+    and skipped when outdir is None.
     """
     if not os.path.isdir(path):
         raise ValueError(f"Invalid path provided: {path}. Please provide a valid directory path.")
@@ -85,7 +207,7 @@ def _generate_adata(path, outdir, sample_type):
             var = pd.read_csv(file_path, header=None, index_col=0, sep="\t")
             var.index.name = "gene"
         elif file == "matrix.mtx.gz":
-            mtx = csr_matrix(mmread(file_path).T)
+            mtx = _load_mtx(file_path, mtx_cache_dir)
 
     if obs is None or var is None or mtx is None:
         raise ValueError("Missing one or more required files: barcodes.tsv.gz, features.tsv.gz, matrix.mtx.gz")
@@ -94,48 +216,104 @@ def _generate_adata(path, outdir, sample_type):
     adata.var_names_make_unique()
     sc.pp.filter_genes(adata, min_cells=1)
     sc.pp.filter_cells(adata, min_genes=1)
-    adata.write(f'{outdir}/{sample_type}.h5ad')
+    if outdir is not None:
+        if submit is not None:
+            submit(adata.write, f'{outdir}/{sample_type}.h5ad')
+        else:
+            adata.write(f'{outdir}/{sample_type}.h5ad')
 
     return adata
 
 
-def generate_json(lrs_rawmtx_path, srs_rawmtx_path, outdir, batch_size, min_genes=None):
+def _rename_obs(adata, obs_names):
+    """
+    Returns an AnnData with new row names that shares X and var with adata.
+
+    adata itself is left untouched, so a background h5ad write of it stays consistent.
+    """
+    obs = adata.obs.copy()
+    obs.index = obs_names
+    return sc.AnnData(adata.X, obs=obs, var=adata.var)
+
+
+def _save_json(data, path):
     """
-    Processes input data and generates JSON files.
+    Dumps data to a JSON file.
     """
-    logging.info("Generating AnnData objects...")
-    l_adata = _generate_adata(lrs_rawmtx_path, outdir, sample_type="lrs")
-    s_adata = _generate_adata(srs_rawmtx_path, outdir, sample_type="srs")
+    with open(path, 'w') as f:
+        json.dump(data, f)
 
-    logging.info("Modifying barcode indices...")
-    l_adata.obs.index = [i[:10] + i[-10:] for i in l_adata.obs.index]
-    s_adata.obs.index = [_numerical_to_dna(i, 20) for i in s_adata.obs.index]
 
-    logging.info("Filtering barcodes based on min_genes...")
-    if min_genes is not None:
-        l_adata_trust = l_adata[l_adata.obs['n_genes'] >= min_genes]
+def _generate_json_chunked(lrs_rawmtx_path, srs_rawmtx_path, outdir, min_genes, output_format, max_memory, write_h5ad):
+    """
+    Memory-budgeted generate_json: the matrices are processed in chunks from on-disk stores under outdir.
+    """
+    with tempfile.TemporaryDirectory(dir=outdir, prefix="chunked_") as workdir:
+        trust_dict, s_items, l_items = chunked_dictionaries(
+            lrs_rawmtx_path, srs_rawmtx_path, workdir, max_memory,
+            rename_lrs=lambda names: [i[:10] + i[-10:] for i in names],
+            rename_srs=lambda names: hex_to_dna(names, 20),
+            min_genes=min_genes, h5ad_dir=outdir if write_h5ad else None)
+        if trust_dict is not None:
+            _save_json(trust_dict, f'{outdir}/l_barcode_trust_dict.json')
+        _save_dict(s_items, outdir, 's_gene_barcode_valid', output_format)
+        _save_dict(l_items, outdir, 'l_barcode_gene_valid', output_format)
 
-        # Save filtered barcodes
-        _barcode_list=list(set(l_adata_trust.obs.index))
-        best_barcode = {i: i for i in _barcode_list}
-        with open(f'{outdir}/l_barcode_trust_dict.json', 'w') as f:
-            json.dump(best_barcode, f)
-            
-        l_adata = l_adata[~l_adata.obs.index.isin(_barcode_list)]
+    logging.info("JSON files generated successfully.")
 
-    logging.info("Filtering genes and generating dictionaries...")
-    gene_list = list(set(s_adata.var.index) & set(l_adata.var.index))
-    l_adata = l_adata[:, l_adata.var.index.isin(gene_list)]
-    s_adata = s_adata[:, s_adata.var.index.isin(gene_list)]
 
-    gene_barcode_dict = _filter_non_zero_indices(s_adata, batch_size)
-    with open(f'{outdir}/s_gene_barcode_valid.json', 'w') as f:
-        json.dump(gene_barcode_dict, f)
+def generate_json(lrs_rawmtx_path, srs_rawmtx_path, outdir, batch_size, min_genes=None, output_format="json",
+                  mtx_cache_dir=None, write_h5ad=True, max_memory=None):
+    """
+    Processes input data and generates JSON files (or CSR directories with output_format="csr").
 
-    l_gene_barcode_dict = _filter_non_zero_indices(l_adata, batch_size)
-    barcode_gene_dict = _invert_dict(l_gene_barcode_dict)
-    with open(f'{outdir}/l_barcode_gene_valid.json', 'w') as f:
-        json.dump(barcode_gene_dict, f)
+    LRS and SRS are loaded concurrently, and the h5ad and JSON files are written by
+    background threads while the remaining work continues. With max_memory (bytes) the
+    matrices are instead processed in chunks from disk; mtx_cache_dir is not used then.
+    """
+    if max_memory is not None:
+        _generate_json_chunked(lrs_rawmtx_path, srs_rawmtx_path, outdir, min_genes, output_format, max_memory, write_h5ad)
+        return
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=2) as writer:
+        def submit(func, *args):
+            futures.append(writer.submit(func, *args))
+
+        logging.info("Generating AnnData objects...")
+        h5ad_dir = outdir if write_h5ad else None
+        with ThreadPoolExecutor(max_workers=2) as loader:
+            l_future = loader.submit(_generate_adata, lrs_rawmtx_path, h5ad_dir, "lrs", mtx_cache_dir, submit)
+            s_future = loader.submit(_generate_adata, srs_rawmtx_path, h5ad_dir, "srs", mtx_cache_dir, submit)
+            l_adata, s_adata = l_future.result(), s_future.result()
+
+        logging.info("Modifying barcode indices...")
+        # Rename on new AnnData objects: the h5ad files may still be being written
+        l_adata = _rename_obs(l_adata, [i[:10] + i[-10:] for i in l_adata.obs.index])
+        s_adata = _rename_obs(s_adata, hex_to_dna(s_adata.obs.index, 20))
+
+        logging.info("Filtering barcodes based on min_genes...")
+        if min_genes is not None:
+            l_adata_trust = l_adata[l_adata.obs['n_genes'] >= min_genes]
+
+            # Save filtered barcodes
+            _barcode_list=list(set(l_adata_trust.obs.index))
+            best_barcode = {i: i for i in _barcode_list}
+            submit(_save_json, best_barcode, f'{outdir}/l_barcode_trust_dict.json')
+
+            l_adata = l_adata[~l_adata.obs.index.isin(_barcode_list)]
+
+        logging.info("Filtering genes and generating dictionaries...")
+        gene_list = list(set(s_adata.var.index) & set(l_adata.var.index))
+        l_adata = l_adata[:, l_adata.var.index.isin(gene_list)]
+        s_adata = s_adata[:, s_adata.var.index.isin(gene_list)]
+
+        submit(_save_dict, _filter_non_zero_indices(s_adata, batch_size), outdir, 's_gene_barcode_valid', output_format)
+        submit(_save_dict, _invert_dict(l_adata), outdir, 'l_barcode_gene_valid', output_format)
+
+        logging.info("Waiting for output files to be written...")
+        for future in futures:
+            future.result()
 
     logging.info("JSON files generated successfully.")
 
@@ -147,6 +325,13 @@ def main():
     parser.add_argument('--outdir', type=str, required=True, help='Output directory to store JSON files')
     parser.add_argument('--batch_size', type=int, default=2000, help='Batch size for processing large datasets')
     parser.add_argument('--min_genes', type=int, default=None, help='Minimum number of genes required for a barcode')
+    parser.add_argument('--output_format', type=str, default='json', choices=['json', 'csr'],
+                        help='Write the gene/barcode dictionaries as JSON, or as memory-mappable CSR .npy directories')
+    parser.add_argument('--mtx_cache_dir', type=str, default=None,
+                        help='Directory caching parsed matrix.mtx.gz files; reused while file size and mtime are unchanged')
+    parser.add_argument('--skip_h5ad', action='store_true', help='Do not write lrs.h5ad and srs.h5ad')
+    parser.add_argument('--max_memory', type=parse_memory, default=None,
+                        help='Memory budget such as 8G; process the matrices in chunks from on-disk stores to stay under it')
 
     args = parser.parse_args()
 
@@ -154,7 +339,8 @@ def main():
         os.makedirs(args.outdir)
         logging.info(f"Created output directory: {args.outdir}")
 
-    generate_json(args.lrs_rawmtx_path, args.srs_rawmtx_path, args.outdir, args.batch_size, args.min_genes)
+    generate_json(args.lrs_rawmtx_path, args.srs_rawmtx_path, args.outdir, args.batch_size, args.min_genes, args.output_format, args.mtx_cache_dir,
+                  not args.skip_h5ad, args.max_memory)
 
 
 if __name__ == '__main__':
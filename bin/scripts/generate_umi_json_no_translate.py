@@ -3,6 +3,18 @@ import json
 import argparse
 import os
 import logging
+import sqlite3
+import tempfile
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = None
+
+from chunked_table import dump_json_items, group_umis, grouped_umis, save_packed_umis
 
 
 
@@ -28,56 +40,163 @@ import logging
 #     return ''.join(dna)
 
 
-def process_data(path, data_type):
+def read_table_pyarrow(path):
+    """
+    Read the space-separated table with the multithreaded pyarrow CSV reader.
+    
+    The "umi" and "gene" columns are dictionary-encoded and returned as pandas categoricals.
+    
+    Parameters:
+    path (str): Path to the input CSV file.
+    
+    Returns:
+    pd.DataFrame: DataFrame with "id", "umi" and "gene" columns.
+    """
+    if pa is None:
+        raise ImportError("pyarrow is required for the pyarrow engine")
+    encoded = pa.dictionary(pa.int32(), pa.string())
+    table = pa_csv.read_csv(
+        path,
+        read_options=pa_csv.ReadOptions(column_names=["id", "umi", "gene"], use_threads=True),
+        parse_options=pa_csv.ParseOptions(delimiter=" "),
+        convert_options=pa_csv.ConvertOptions(column_types={"umi": encoded, "gene": encoded}, strings_can_be_null=True),
+    )
+    return table.to_pandas()
+
+
+def process_data(path, data_type, engine="pandas"):
     """
     Read and process the input CSV file based on data type (LRS or SRS).
     
     Parameters:
     path (str): Path to the input CSV file.
     data_type (str): Type of data ('lrs' or 'srs').
+    engine (str): 'pandas' for the pandas C parser, 'pyarrow' for read_table_pyarrow.
     
     Returns:
     pd.DataFrame: Processed DataFrame.
     """
-    # Read the CSV file, assuming columns are separated by spaces and there is no header
-    data = pd.read_csv(path, sep=" ", header=None)
-    data = data.rename(columns={0: "id", 1: "umi", 2: "gene"})
+    if engine == "pyarrow":
+        data = read_table_pyarrow(path)
+    else:
+        # Read the CSV file, assuming columns are separated by spaces and there is no header
+        data = pd.read_csv(path, sep=" ", header=None)
+        data = data.rename(columns={0: "id", 1: "umi", 2: "gene"})
     data = data.drop_duplicates()
+    return annotate_data(data, data_type)
+
+
+def annotate_data(data, data_type):
+    """
+    Add the "barcode" and "gene_barcode" ("gb") columns to a table read by process_data.
+    
+    Parameters:
+    data (pd.DataFrame): Table with "id", "umi" and "gene" columns.
+    data_type (str): Type of data ('lrs' or 'srs').
     
+    Returns:
+    pd.DataFrame: The same DataFrame with the added columns.
+    """
     if data_type == 'srs':
         # data['barcode'] = [_numerical_to_dna(i, 20) for i in data['id']]
         data['barcode'] = data['id'].to_list()
     if data_type == 'lrs':
         data['barcode'] = [i[:10]+i[-10:] for i in data['id']]
         
-    data['gb'] = data['gene'] +"_"+ data['barcode']
+    # astype(object) also turns dictionary-encoded genes back into strings
+    data['gb'] = data['gene'].astype(object) +"_"+ data['barcode']
         
     return data
 
 
-def save_data(data, output_dir, data_type):
+def save_sqlite(items, sqlite_file):
+    """
+    Save aggregated UMIs to an indexed SQLite table so consumers can look up keys lazily.
+    
+    Parameters:
+    items (iterable): ("gene_barcode", list of UMIs) pairs.
+    sqlite_file (str): Output SQLite file path.
+    """
+    if os.path.exists(sqlite_file):
+        os.remove(sqlite_file)
+    with sqlite3.connect(sqlite_file) as conn:
+        conn.execute("CREATE TABLE gene_barcode_umi (gb TEXT PRIMARY KEY, umi TEXT NOT NULL) WITHOUT ROWID")
+        conn.executemany("INSERT INTO gene_barcode_umi VALUES (?, ?)",
+                         ((gb, json.dumps(umi)) for gb, umi in items))
+    conn.close()
+
+
+def save_data(data, output_dir, data_type, output_format="json"):
     """
-    Save aggregated data to CSV and JSON files.
+    Save aggregated data to JSON or SQLite files.
     
     Parameters:
     data_info (pd.DataFrame): Aggregated DataFrame.
     output_dir (str): Output directory.
     data_type (str): Type of data ('lrs' or 'srs').
+    output_format (str): 'json' for a JSON dict, 'sqlite' for an indexed SQLite table,
+        'packed' for sorted, deduplicated 2-bit packed UMIs (see save_packed_umis).
     """
     # Ensure output directory exists
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
     
-    data_info = data.groupby("gb").agg({"umi": list})
+    items = group_umis(data)
+    if output_format == "sqlite":
+        save_sqlite(items, f"{output_dir}/{data_type}_gene_barcode_umi.sqlite")
+        logging.info(f"Output files saved to {output_dir} for {data_type.upper()} data.")
+        return
+    if output_format == "packed":
+        save_packed_umis(items, f"{output_dir}/{data_type}_gene_barcode_umi.packed")
+        logging.info(f"Output files saved to {output_dir} for {data_type.upper()} data.")
+        return
     # Save aggregated data to JSON
     json_file = f"{output_dir}/{data_type}_gene_barcode_umi.json"
-    d_dict = data_info.to_dict()['umi']
+    d_dict = dict(items)
     with open(json_file, 'w') as f:
         json.dump(d_dict, f)
     logging.info(f"Output files saved to {output_dir} for {data_type.upper()} data.")
 
 
-def main(lrs_path, srs_path, output_dir):
+def save_data_chunked(path, output_dir, data_type, output_format="json", chunk_size=1_000_000, partitions=64, workers=1):
+    """
+    Out-of-core process_data and save_data for tables larger than memory.
+    
+    Rows are streamed in chunks and hash-partitioned by gene_barcode into spill files under
+    output_dir, which are deduplicated and aggregated one at a time (workers in parallel)
+    and merged into the same sorted output as save_data. All columns are read as strings.
+    
+    Parameters:
+    path (str): Path to the input CSV file.
+    output_dir (str): Output directory.
+    data_type (str): Type of data ('lrs' or 'srs').
+    output_format (str): 'json', 'sqlite' or 'packed'.
+    chunk_size (int): Rows read per chunk.
+    partitions (int): Number of spill files.
+    workers (int): Number of processes aggregating partitions.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    
+    with tempfile.TemporaryDirectory(dir=output_dir, prefix=f"{data_type}_chunked_") as workdir:
+        items = grouped_umis(path, workdir, partial(annotate_data, data_type=data_type), partitions, chunk_size, workers)
+        if output_format == "sqlite":
+            save_sqlite(items, f"{output_dir}/{data_type}_gene_barcode_umi.sqlite")
+        elif output_format == "packed":
+            save_packed_umis(items, f"{output_dir}/{data_type}_gene_barcode_umi.packed")
+        else:
+            with open(f"{output_dir}/{data_type}_gene_barcode_umi.json", 'w') as f:
+                dump_json_items(items, f)
+    logging.info(f"Output files saved to {output_dir} for {data_type.upper()} data.")
+
+
+def process_and_save(path, output_dir, data_type, output_format="json", engine="pandas"):
+    """
+    Process one input file with process_data and save it with save_data.
+    """
+    save_data(process_data(path, data_type, engine), output_dir, data_type, output_format)
+
+
+def main(lrs_path, srs_path, output_dir, output_format="json", chunk_size=None, partitions=64, workers=1,
+         engine="pandas"):
     """
     Main function to process LRS and SRS data and generate output files.
     
@@ -85,14 +204,25 @@ def main(lrs_path, srs_path, output_dir):
     lrs_path (str): Path to the LRS input CSV file.
     srs_path (str): Path to the SRS input CSV file.
     output_dir (str): Output directory for generated files.
+    output_format (str): 'json', 'sqlite' or 'packed'.
+    chunk_size (int): If set, process the inputs out of core in chunks of this many rows.
+    partitions (int): Number of spill files in the chunked mode.
+    workers (int): Number of processes aggregating partitions in the chunked mode.
+    engine (str): 'pandas' or 'pyarrow' CSV reader (not used in the chunked mode).
     """
-    # Process and save LRS data
-    lrs_data = process_data(lrs_path, 'lrs')
-    save_data(lrs_data, output_dir, 'lrs')
+    if chunk_size:
+        # Partitions are already aggregated by worker processes, which should not be forked from threads
+        save_data_chunked(lrs_path, output_dir, 'lrs', output_format, chunk_size, partitions, workers)
+        save_data_chunked(srs_path, output_dir, 'srs', output_format, chunk_size, partitions, workers)
+        return
     
-    # Process and save SRS data
-    srs_data = process_data(srs_path, 'srs')
-    save_data(lrs_data, output_dir, 'srs')
+    os.makedirs(output_dir, exist_ok=True)
+    # Process and save LRS and SRS data concurrently; the CSV readers release the GIL while parsing
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(process_and_save, path, output_dir, data_type, output_format, engine)
+                   for data_type, path in (('lrs', lrs_path), ('srs', srs_path))]
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
@@ -101,9 +231,19 @@ if __name__ == "__main__":
     parser.add_argument("--lrs_path", help="The path to the LRS input CSV file.")
     parser.add_argument("--srs_path", help="The path to the SRS input CSV file.")
     parser.add_argument("--outdir", help="The directory where the output files will be saved.")
+    parser.add_argument("--format", default="json", choices=["json", "sqlite", "packed"],
+                        help="Output format: a JSON dict, an indexed SQLite table for lazy lookups, or a directory of "
+                             "sorted, deduplicated 2-bit packed UMIs with an offsets index.")
+    parser.add_argument("--chunk_size", type=int, default=None,
+                        help="Rows per chunk; enables the out-of-core mode for inputs larger than memory.")
+    parser.add_argument("--partitions", type=int, default=64, help="Number of spill files in the out-of-core mode.")
+    parser.add_argument("--workers", type=int, default=1, help="Processes aggregating spill files in the out-of-core mode.")
+    parser.add_argument("--engine", default="pandas", choices=["pandas", "pyarrow"],
+                        help="CSV reader: the pandas C parser, or the multithreaded pyarrow reader with dictionary-encoded columns.")
     
     # Parse command line arguments
     args = parser.parse_args()
     
     # Call the main function
-    main(args.lrs_path, args.srs_path, args.outdir)
+    main(args.lrs_path, args.srs_path, args.outdir, args.format, args.chunk_size, args.partitions, args.workers,
+         args.engine)
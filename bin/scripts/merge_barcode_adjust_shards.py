@@ -0,0 +1,23 @@
+import os
+import argparse
+
+from barcode_adjust_gene import OUTPUT_FILES, merge_shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the output directories of barcode_adjust_gene.py --shard i/N runs.")
+    parser.add_argument("shard_dirs", type=str, nargs="+", help="Output directories of all shard runs.")
+    parser.add_argument("--output-dir", type=str, required=True, help="Output directory for the merged results.")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    try:
+        merge_shards(args.shard_dirs, args.output_dir)
+    except (ValueError, FileNotFoundError) as e:
+        print(f"Error merging shards: {e}")
+        exit(1)
+    print(f"Merged {len(args.shard_dirs)} shards into " + ", ".join(OUTPUT_FILES.values()) + f" under {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()